@@ -0,0 +1,98 @@
+"""
+Batch preprocessing benchmark for OCT image SRF detection.
+
+Compares the preprocessing of a stack of same-sized scans (oct_preprocessing.perform_bulk_perproc_stack() and
+oct_template_matching.pyramid_levels_stack()) against the image by image pipeline (perform_bulk_perproc() and
+pyramid_levels()): the time per image of both versions and whether the outputs are identical. The scans are
+synthetic OCT-like images (see bench_pipeline.py) of a fixed size, like those of a single scanner.
+
+Usage (from the project root):
+    python benchmarks/bench_batch.py [--size 496x512] [--count 64] [--repeat 5]
+
+Exits with status 1 if any output differs from the image by image pipeline.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+from bench_pipeline import synthetic_image
+
+
+SETTINGS = [['eq'], ['eq', 'opening'], ['crop', 'eq'], ['crop', 'eq', 'opening']]
+DENOISE_STRENGTH = 5
+
+
+def timed(function, repeat):
+    """Return the output of the last run and the median time of repeat runs (after a warm-up run) in seconds."""
+    function()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = function()
+        times.append(time.perf_counter() - start)
+    return output, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', default='496x512', help='size (rows x cols) of the synthetic scans')
+    parser.add_argument('--count', type=int, default=64, help='number of scans in the stack')
+    parser.add_argument('--repeat', type=int, default=5, help='number of timed runs')
+    args = parser.parse_args()
+
+    rows, cols = (int(n) for n in args.size.lower().split('x'))
+    rng = np.random.RandomState(0)
+    stack = np.stack([synthetic_image(rows, cols, rng) for _ in range(args.count)])
+    images = list(stack)
+
+    print('{:<28}{:>16}{:>16}{:>10}{:>11}'.format('stage', 'per image ms', 'stack ms', 'speedup', 'identical'))
+    failed = False
+    for methods in SETTINGS:
+        single, single_time = timed(lambda: [preproc.perform_bulk_perproc(i, methods, DENOISE_STRENGTH)
+                                             for i in images], args.repeat)
+        batch, batch_time = timed(lambda: preproc.perform_bulk_perproc_stack(stack, methods, DENOISE_STRENGTH),
+                                  args.repeat)
+        identical = all(np.array_equal(a, b) for a, b in zip(single, batch))
+        failed |= not identical
+        print('{:<28}{:>16.3f}{:>16.3f}{:>9.2f}x{:>11}'.format(
+            '+'.join(methods), single_time / args.count * 1000, batch_time / args.count * 1000,
+            single_time / batch_time, str(identical)))
+
+    # pyramid of the whole stack, the buffers of the first call are reused like for the next batch of a scanner
+    buffers = tmpmatch.pyramid_levels_stack(stack)
+    single, single_time = timed(lambda: [tmpmatch.pyramid_levels(i) for i in images], args.repeat)
+    batch, batch_time = timed(lambda: tmpmatch.pyramid_levels_stack(stack, out=buffers), args.repeat)
+    identical = all(np.array_equal(level, stack_level[index])
+                    for index, levels in enumerate(single)
+                    for (_, level), (_, stack_level) in zip(levels, batch))
+    failed |= not identical
+    print('{:<28}{:>16.3f}{:>16.3f}{:>9.2f}x{:>11}'.format('pyramid_levels', single_time / args.count * 1000,
+                                                           batch_time / args.count * 1000,
+                                                           single_time / batch_time, str(identical)))
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""
+Coarse to fine matching benchmark for OCT image SRF detection.
+
+Compares the coarse to fine search (see coarse_to_fine_matching() in 'oct_template_matching.py') against the
+exhaustive search of every pyramid level on the train-data: time per image, deviation of the best scores (the
+tolerance of the coarse to fine search), number of missed best matches and the agreement of the labels, also
+with early exit at the decision threshold.
+
+Usage (from the project root):
+    python benchmarks/bench_coarse_to_fine.py [--method cv.TM_CCOEFF_NORMED] [--top-k 5] [--factor 2]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+
+
+PREPROC_METHODS = ['crop', 'eq', 'nonloc']
+DENOISE_STRENGTH = 23
+
+
+def timed(function, levels):
+    """Apply the function to the levels of all images, return the matches and the time per image in ms."""
+    start = time.perf_counter()
+    matches = [function(level) for level in levels]
+    return matches, (time.perf_counter() - start) / len(levels) * 1000
+
+
+def labels(scores, threshold, method):
+    if method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+        return scores <= threshold
+    return scores >= threshold
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--method', default='cv.TM_CCOEFF_NORMED', help='template matching method')
+    parser.add_argument('--top-k', type=int, default=tmpmatch.COARSE_TOP_K, help='refined candidates per level')
+    parser.add_argument('--factor', type=int, default=tmpmatch.COARSE_FACTOR, help='downscaling factor')
+    args = parser.parse_args()
+    os.chdir(ROOT_DIR)
+
+    paths_srf = sorted(glob.glob('Train-Data/SRF/*.png'))
+    paths_no = sorted(glob.glob('Train-Data/NoSRF/*.png'))
+    template = tmpmatch.build_template('', PREPROC_METHODS, DENOISE_STRENGTH)
+    levels = [tmpmatch.pyramid_levels(preproc.perform_bulk_perproc(preproc.load_img_as_gray(i), PREPROC_METHODS,
+                                                                   DENOISE_STRENGTH))
+              for i in paths_srf + paths_no]
+
+    exhaustive, exhaustive_ms = timed(lambda l: tmpmatch.multiscale_matching(l, template, args.method), levels)
+    coarse, coarse_ms = timed(lambda l: tmpmatch.coarse_to_fine_matching(l, template, args.method, args.factor,
+                                                                         args.top_k), levels)
+    scores_exhaustive = np.array([m[0] for m in exhaustive])
+    scores_coarse = np.array([m[0] for m in coarse])
+
+    # decision threshold with the best precision on the exhaustive scores
+    thresholds = np.unique(scores_exhaustive)
+    precisions = evaluate.precision_curve(thresholds, scores_exhaustive[:len(paths_srf)],
+                                          scores_exhaustive[len(paths_srf):], args.method)
+    threshold = thresholds[np.argmax(precisions)]
+    early, early_ms = timed(lambda l: tmpmatch.coarse_to_fine_matching(l, template, args.method, args.factor,
+                                                                       args.top_k, stop_at=threshold), levels)
+    scores_early = np.array([m[0] for m in early])
+
+    deviation = np.abs(scores_coarse - scores_exhaustive) / np.maximum(np.abs(scores_exhaustive), 1e-12)
+    missed = sum((m[1], round(m[2], 6)) != (e[1], round(e[2], 6)) for m, e in zip(coarse, exhaustive))
+
+    print('{} images, {}, top-k {}, factor {}\n'.format(len(levels), args.method, args.top_k, args.factor))
+    print('{:<32}{:>10}{:>10}'.format('search', 'ms/image', 'speedup'))
+    for name, ms in [('exhaustive', exhaustive_ms), ('coarse to fine', coarse_ms),
+                     ('coarse to fine, early exit', early_ms)]:
+        print('{:<32}{:>10.1f}{:>9.1f}x'.format(name, ms, exhaustive_ms / ms))
+
+    print('\nrelative score deviation: mean {:.2e}, max {:.2e}'.format(deviation.mean(), deviation.max()))
+    print('best matches missed: {} of {}'.format(missed, len(levels)))
+    print('labels at threshold {:.4f} equal to exhaustive search: {} of {} (early exit: {} of {})'.format(
+        threshold, np.sum(labels(scores_coarse, threshold, args.method) == labels(scores_exhaustive, threshold,
+                                                                                  args.method)),
+        len(levels), np.sum(labels(scores_early, threshold, args.method) == labels(scores_exhaustive, threshold,
+                                                                                   args.method)),
+        len(levels)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+"""
+Denoising benchmark for OCT image SRF detection.
+
+Times the non-local means denoising of the tuned setting (crop, eq, nonloc with strength 23) on the train-data:
+image by image, batched on a pool of threads, and the fast approximate mode ('nonloc_fast') on the half-sized
+images. For the fast mode the drift of the matching scores and of the best precision on the train-data is reported,
+since it does not reproduce the exact output.
+
+Usage (from the project root):
+    python benchmarks/bench_denoising.py [--strength 23] [--threads N] [--template-window 7] [--search-window 21]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+
+
+MATCHING_METHOD = 'cv.TM_CCOEFF_NORMED'
+
+
+def best_precision(scores_srf, scores_no):
+    """Return the best precision over all thresholds between the given scores."""
+    thresholds = np.unique(np.concatenate([scores_srf, scores_no]))
+    return evaluate.precision_curve(thresholds, scores_srf, scores_no, MATCHING_METHOD).max()
+
+
+def scores(images, template):
+    return np.array([tmpmatch.locate_best_match(img, template, MATCHING_METHOD)[0] for img in images])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--strength', type=int, default=23, help='denoise strength h')
+    parser.add_argument('--threads', type=int, default=os.cpu_count(), help='threads of the batched denoising')
+    parser.add_argument('--template-window', type=int, default=preproc.NONLOC_TEMPLATE_WINDOW)
+    parser.add_argument('--search-window', type=int, default=preproc.NONLOC_SEARCH_WINDOW)
+    args = parser.parse_args()
+    os.chdir(ROOT_DIR)
+
+    paths_srf = sorted(glob.glob('Train-Data/SRF/*.png'))
+    paths_no = sorted(glob.glob('Train-Data/NoSRF/*.png'))
+    images = preproc.perform_bulk_perproc_batch([preproc.load_img_as_gray(i) for i in paths_srf + paths_no],
+                                                ['crop', 'eq'], args.strength)
+    windows = {'template_window': args.template_window, 'search_window': args.search_window}
+
+    start = time.perf_counter()
+    exact = [preproc.nonloc_denoising(img, args.strength, **windows) for img in images]
+    serial_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batched = preproc.nonloc_denoising_batch(images, args.strength, args.threads, **windows)
+    batched_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    fast = preproc.nonloc_denoising_batch(images, args.strength, args.threads, fast=True, **windows)
+    fast_s = time.perf_counter() - start
+
+    print('{} images, strength {}, windows {}/{}\n'.format(len(images), args.strength, args.template_window,
+                                                          args.search_window))
+    print('{:<28}{:>10}{:>10}'.format('mode', 'ms/image', 'speedup'))
+    for name, seconds in [('nonloc (per image)', serial_s), ('nonloc ({} threads)'.format(args.threads), batched_s),
+                          ('nonloc_fast ({} threads)'.format(args.threads), fast_s)]:
+        print('{:<28}{:>10.1f}{:>9.1f}x'.format(name, seconds / len(images) * 1000, serial_s / seconds))
+    print('batched output identical: {}'.format(all(np.array_equal(a, b) for a, b in zip(exact, batched))))
+
+    # score drift of the fast mode, each mode is matched against the template preprocessed the same way
+    template_exact = tmpmatch.build_template('', ['crop', 'eq', 'nonloc'], args.strength)
+    template_fast = tmpmatch.build_template('', ['crop', 'eq', 'nonloc_fast'], args.strength)
+    scores_exact = scores(exact, template_exact)
+    scores_fast = scores(fast, template_fast)
+    drift = np.abs(scores_fast - scores_exact)
+    n_srf = len(paths_srf)
+
+    print('\nscore drift of nonloc_fast ({}): mean {:.4f}, max {:.4f}'.format(MATCHING_METHOD, drift.mean(),
+                                                                            drift.max()))
+    print('best precision on the train-data: nonloc {:.3f}, nonloc_fast {:.3f}'.format(
+        best_precision(scores_exact[:n_srf], scores_exact[n_srf:]),
+        best_precision(scores_fast[:n_srf], scores_fast[n_srf:])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Import-time benchmark for OCT image SRF detection.
+
+Guards the lean import graph of the inference path (load -> preprocess -> match -> classify -> csv): importing the
+inference modules must not load plotting, sklearn or tqdm, which are only needed for evaluation and tuning.
+Every module is imported in a fresh interpreter, the median wall time over several runs is reported.
+
+Usage (from the project root):
+    python benchmarks/bench_import.py [--repeat 5] [--max-seconds 2.0]
+
+Exits with status 1 if a forbidden module is loaded or an import is slower than --max-seconds.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules on the inference path and modules which must not be loaded by them
+INFERENCE_MODULES = ['oct_preprocessing', 'oct_template_matching', 'oct_model', 'oct_inference', 'oct_service']
+FORBIDDEN_MODULES = ['matplotlib', 'sklearn', 'tqdm']
+
+PROBE = '''
+import sys, time, json
+t = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - t
+print(json.dumps({{'seconds': elapsed, 'loaded': [m for m in {forbidden} if m in sys.modules]}}))
+'''
+
+
+def measure(module, repeat):
+    """Import the module in fresh interpreters, return the median import time and the forbidden modules loaded."""
+    times = []
+    loaded = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', PROBE.format(module=module, forbidden=FORBIDDEN_MODULES)],
+                             cwd=ROOT_DIR, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        result = json.loads(out.strip().splitlines()[-1])
+        times.append(result['seconds'])
+        loaded = result['loaded']
+
+    return sorted(times)[len(times) // 2], loaded
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--repeat', type=int, default=5, help='number of fresh interpreters per module')
+    parser.add_argument('--max-seconds', type=float, default=None, help='fail if an import takes longer')
+    args = parser.parse_args()
+
+    failed = False
+    for module in INFERENCE_MODULES:
+        seconds, loaded = measure(module, args.repeat)
+        status = 'ok'
+        if loaded:
+            status = 'FAIL: loads {}'.format(', '.join(loaded))
+            failed = True
+        elif args.max_seconds is not None and seconds > args.max_seconds:
+            status = 'FAIL: slower than {}s'.format(args.max_seconds)
+            failed = True
+        print('{:<25}{:>8.3f}s   {}'.format(module, seconds, status))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,220 @@
+"""
+Pipeline benchmark for OCT image SRF detection.
+
+Times every stage of the detection pipeline (load_img_as_gray, crop, hist_equalize, opening_denoising,
+nonloc_denoising, pyramid vs fast_pyramid, template_matching per method and eval_precision) on synthetic
+OCT-like images of configurable size and on the bundled Train-Data. The results are written as JSON, a previous
+result can be passed with --compare to flag regressions.
+
+Usage (from the project root):
+    python benchmarks/bench_pipeline.py [--size 496x512] [--count 10] [--repeat 3] [--output bench.json]
+    python benchmarks/bench_pipeline.py --compare bench.json [--tolerance 0.1]
+
+Exits with status 1 if a stage is slower than in the compared result by more than the tolerance.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import glob
+import json
+import time
+import argparse
+import platform
+import tempfile
+import numpy as np
+import cv2 as cv
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+# eval_precision() plots, no display is needed for that
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+
+
+DENOISE_STRENGTH = 23
+TEMPLATE_SIZE = 40
+
+# differences below this many ms per image are never flagged as regression (timer noise)
+MIN_DIFFERENCE_MS = 0.05
+
+
+def synthetic_image(rows, cols, rng):
+    """Return an OCT-like uint8 image: white border, dark background, a curved bright retina and speckle noise."""
+    img = np.full((rows, cols), 255, dtype=np.uint8)
+
+    x = np.arange(cols - 100)
+    center = (rows - 100) / 2 + (rows - 100) / 8 * np.sin(2 * np.pi * x / (cols - 100) + rng.uniform(0, np.pi))
+    y = np.arange(rows - 100)[:, None]
+    thickness = (rows - 100) / 6
+
+    # retina with a bright RPE at its bottom and a dark fluid pocket in some images
+    inner = 30 + 120 * (np.abs(y - center) < thickness) + 80 * (np.abs(y - center - thickness) < 4)
+    if rng.uniform() < 0.5:
+        pocket = (np.abs(y - center - thickness / 2) < thickness / 4) & (np.abs(x - (cols - 100) / 2) < cols / 10)
+        inner = np.where(pocket, 40, inner)
+
+    speckle = rng.gamma(4, 1 / 4, size=inner.shape)
+    img[50:rows - 50, 50:cols - 50] = np.clip(inner * speckle, 0, 254).astype(np.uint8)
+    return img
+
+
+def write_synthetic_images(directory, count, rows, cols, seed=0):
+    """Write count synthetic images as png to the directory, return their paths."""
+    rng = np.random.RandomState(seed)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, 'synthetic_{}.png'.format(i))
+        cv.imwrite(path, synthetic_image(rows, cols, rng))
+        paths.append(path)
+    return paths
+
+
+def timed(function, inputs, repeat):
+    """Apply the function to all inputs repeat times, after an untimed warm-up run on the first input.
+
+    :return: outputs of the last run and timing dict (median and min time per input in ms)
+    """
+    # lazy imports, caches and allocations of the first call are not part of the timings
+    function(inputs[0])
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(i) for i in inputs]
+        times.append((time.perf_counter() - start) / len(inputs) * 1000)
+    return outputs, {'ms': sorted(times)[len(times) // 2], 'min_ms': min(times), 'repeat': repeat,
+                     'inputs': len(inputs)}
+
+
+def bench_dataset(image_paths, repeat):
+    """Time all stages of the pipeline on the images, return dict of stage name to timing dict."""
+    results = {}
+
+    images, results['load_img_as_gray'] = timed(preproc.load_img_as_gray, image_paths, repeat)
+    cropped, results['crop'] = timed(preproc.crop, images, repeat)
+    equalized, results['hist_equalize'] = timed(preproc.hist_equalize, cropped, repeat)
+    _, results['opening_denoising'] = timed(lambda i: preproc.opening_denoising(i, 5), equalized, repeat)
+    denoised, results['nonloc_denoising'] = timed(lambda i: preproc.nonloc_denoising(i, DENOISE_STRENGTH),
+                                                  equalized, repeat)
+    pyramids, results['pyramid'] = timed(tmpmatch.pyramid, denoised, repeat)
+    try:
+        _, results['fast_pyramid'] = timed(tmpmatch.fast_pyramid, denoised, repeat)
+    except Exception as e:
+        # depends on the skimage version
+        results['fast_pyramid'] = {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    # template from the middle of the first preprocessed image
+    rows, cols = denoised[0].shape
+    top, left = (rows - TEMPLATE_SIZE) // 2, (cols - TEMPLATE_SIZE) // 2
+    template = denoised[0][top:top + TEMPLATE_SIZE, left:left + TEMPLATE_SIZE].copy()
+
+    scores = None
+    for meth in tmpmatch.MATCHING_METHODS:
+        maps, results['template_matching/' + meth] = timed(lambda i: tmpmatch.template_matching(i, template, meth)[0],
+                                                           pyramids, repeat)
+        if meth == 'cv.TM_CCOEFF_NORMED':
+            scores = [tmpmatch.best_score(res, meth) for res in maps]
+
+    # the first half of the images as srf, the others as non-srf images
+    half = max(len(scores) // 2, 1)
+    with tempfile.TemporaryDirectory() as directory:
+        os.makedirs(os.path.join(directory, 'figures'))
+        cwd = os.getcwd()
+        os.chdir(directory)
+        try:
+            _, results['eval_precision'] = timed(
+                lambda s: evaluate.eval_precision(0, 1, 0.0001, s[:half], s[half:], ['crop', 'eq', 'nonloc'],
+                                                  'cv.TM_CCOEFF_NORMED', 'benchmark', stdout=False),
+                [scores], repeat)
+        finally:
+            os.chdir(cwd)
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """Print the comparison of two benchmark results, return the list of regressed stages."""
+    regressions = []
+    print('{:<50}{:>12}{:>12}{:>9}'.format('stage', 'baseline ms', 'current ms', 'ratio'))
+    for name, timing in sorted(results['stages'].items()):
+        old = baseline['stages'].get(name)
+        if old is None or 'ms' not in old or 'ms' not in timing:
+            print('{:<50}{:>12}{:>12}'.format(name, '-' if old is None or 'ms' not in old else round(old['ms'], 2),
+                                              round(timing['ms'], 2) if 'ms' in timing else '-'))
+            continue
+
+        ratio = timing['ms'] / old['ms'] if old['ms'] > 0 else float('inf')
+        regressed = ratio > 1 + tolerance and timing['ms'] - old['ms'] > MIN_DIFFERENCE_MS
+        if regressed:
+            regressions.append(name)
+        print('{:<50}{:>12.2f}{:>12.2f}{:>8.2f}x{}'.format(name, old['ms'], timing['ms'], ratio,
+                                                          '   REGRESSION' if regressed else ''))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', default='496x512', help='size (rows x cols) of the synthetic images')
+    parser.add_argument('--count', type=int, default=10, help='number of synthetic images')
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per stage')
+    parser.add_argument('--no-train-data', action='store_true', help='only benchmark the synthetic images')
+    parser.add_argument('--output', default=None, help='write the results as json to this file')
+    parser.add_argument('--compare', default=None, help='json result of a previous run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed slowdown (0.1 = 10%%)')
+    args = parser.parse_args()
+
+    rows, cols = (int(n) for n in args.size.lower().split('x'))
+    results = {
+        'meta': {'python': platform.python_version(), 'numpy': np.__version__, 'opencv': cv.__version__,
+                 'cpu_count': os.cpu_count(), 'platform': platform.platform(), 'size': [rows, cols],
+                 'count': args.count, 'repeat': args.repeat},
+        'stages': {},
+    }
+
+    datasets = []
+    with tempfile.TemporaryDirectory() as directory:
+        datasets.append(('synthetic', write_synthetic_images(directory, args.count, rows, cols)))
+        train_paths = sorted(glob.glob(os.path.join(ROOT_DIR, 'Train-Data', '*', '*.png')))
+        if train_paths and not args.no_train_data:
+            datasets.append(('train', train_paths))
+
+        for dataset, paths in datasets:
+            print('Benchmarking {} ({} images)...'.format(dataset, len(paths)))
+            for stage, timing in bench_dataset(paths, args.repeat).items():
+                results['stages']['{}/{}'.format(dataset, stage)] = timing
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('Saved results in {}'.format(args.output))
+
+    if args.compare is None:
+        print(json.dumps(results['stages'], indent=2, sort_keys=True))
+        return
+
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('\n{} stage(s) slower than {} by more than {}%'.format(len(regressions), args.compare,
+                                                                     round(args.tolerance * 100)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
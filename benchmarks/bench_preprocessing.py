@@ -0,0 +1,112 @@
+"""
+Preprocessing benchmark for OCT image SRF detection.
+
+Compares the uint8-native kernels of 'oct_preprocessing.py' (separable blur, otsu from a 256-bin histogram,
+bounding box by row / column reductions, equalization by lookup table) against the original skimage based
+implementations, stage by stage: the median time per image of both versions and whether the outputs are identical.
+
+Usage (from the project root):
+    python benchmarks/bench_preprocessing.py [image_dir ...] [--repeat 3]
+
+Exits with status 1 if any output differs from the reference implementation.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import glob
+import time
+import argparse
+import numpy as np
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import oct_preprocessing as preproc
+
+
+def reference_otsu_binarize(img, sigma=1):
+    """Original implementation of oct_preprocessing.otsu_binarize()."""
+    from skimage.filters import threshold_otsu, gaussian
+
+    img_blur = gaussian(img, sigma=sigma)
+    return img_blur > threshold_otsu(img_blur)
+
+
+def reference_crop(img, border=50):
+    """Original implementation of oct_preprocessing.crop()."""
+    img_no_border = img[border:img.shape[0]-border, border:img.shape[1]-border]
+    img_bin = reference_otsu_binarize(img_no_border, 10)
+
+    white_pixels = np.where(img_bin == 1)
+    up, bottom = min(white_pixels[0]), max(white_pixels[0])
+    left, right = min(white_pixels[1]), max(white_pixels[1])
+    return img_no_border[up:bottom, left:right]
+
+
+def reference_hist_equalize(img):
+    """Original implementation of oct_preprocessing.hist_equalize() (for uint8 gray-scale images)."""
+    from skimage import exposure
+
+    eq = exposure.equalize_hist(img) * 255
+    return eq.astype(np.uint8)
+
+
+def timed(function, images, repeat):
+    """Apply the function to all images, return the outputs and the median time per image in ms."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        outputs = [function(img) for img in images]
+        times.append((time.perf_counter() - start) / len(images) * 1000)
+    return outputs, sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('image_dirs', nargs='*', default=[os.path.join(ROOT_DIR, 'Train-Data', 'SRF'),
+                                                          os.path.join(ROOT_DIR, 'Train-Data', 'NoSRF')])
+    parser.add_argument('--repeat', type=int, default=3, help='number of timed runs per stage')
+    args = parser.parse_args()
+
+    images = [preproc.load_img_as_gray(i) for d in args.image_dirs for i in sorted(glob.glob(os.path.join(d, '*.png')))]
+    if not images:
+        sys.exit('No images found in {}'.format(', '.join(args.image_dirs)))
+    border_free = [img[50:img.shape[0]-50, 50:img.shape[1]-50] for img in images]
+    cropped = [preproc.crop(img) for img in images]
+
+    # stage name, reference implementation, new implementation, inputs
+    stages = [
+        ('otsu_binarize', lambda img: reference_otsu_binarize(img, 10), lambda img: preproc.otsu_binarize(img, 10),
+         border_free),
+        ('crop', reference_crop, preproc.crop, images),
+        ('hist_equalize', reference_hist_equalize, preproc.hist_equalize, cropped),
+    ]
+
+    print('{} images\n'.format(len(images)))
+    print('{:<16}{:>14}{:>14}{:>10}   {}'.format('stage', 'reference ms', 'new ms', 'speedup', 'outputs'))
+    failed = False
+    for name, reference, new, inputs in stages:
+        expected, reference_ms = timed(reference, inputs, args.repeat)
+        actual, new_ms = timed(new, inputs, args.repeat)
+        identical = all(a.shape == b.shape and np.array_equal(a, b) for a, b in zip(expected, actual))
+        failed = failed or not identical
+        print('{:<16}{:>14.2f}{:>14.2f}{:>9.1f}x   {}'.format(name, reference_ms, new_ms, reference_ms / new_ms,
+                                                              'identical' if identical else 'DIFFERENT'))
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+"""
+Matching workspace benchmark for OCT image SRF detection.
+
+Matches a long batch of preprocessed images with all matching methods, once like the original implementation
+(pyramid from separately resized levels, a copy of the pyramid with the best match drawn and a new distance map
+per method) and once with the buffers of an oct_template_matching.MatchWorkspace. Every mode runs in its own
+process, reported are the time per image, the median and maximum peak of the memory traced while matching an
+image (temporary allocations, the maximum includes the growth of the workspace) and the peak RSS of the process. The scores of both modes must be identical.
+
+Usage (from the project root):
+    python benchmarks/bench_workspace.py [--size 400x450] [--count 200]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tracemalloc
+import subprocess
+import numpy as np
+import cv2 as cv
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+
+import oct_template_matching as tmpmatch
+
+
+TEMPLATE_SIZE = 40
+MODES = ['original', 'workspace']
+
+
+def reference_pyramid(img):
+    """Original implementation of oct_template_matching.pyramid() (levels resized separately, then copied)."""
+    levels = [level for _, level in tmpmatch.pyramid_levels(img)]
+    img_pyr = np.zeros((sum(level.shape[0] for level in levels), levels[0].shape[1]), dtype=img.dtype)
+    row = 0
+    for level in levels:
+        img_pyr[row:row + level.shape[0], :level.shape[1]] = level
+        row += level.shape[0]
+    return img_pyr
+
+
+def match_original(img, template):
+    img_pyr = reference_pyramid(img)
+    # the original template_matching() always drew the best match into a copy of the pyramid
+    return [tmpmatch.best_score(tmpmatch.template_matching(img_pyr, template, meth, draw=True)[0], meth)
+            for meth in tmpmatch.MATCHING_METHODS]
+
+
+def match_workspace(img, template, workspace):
+    img_pyr = tmpmatch.pyramid(img, workspace.get('pyramid', tmpmatch.pyramid_shape(img.shape)))
+    result = workspace.get('result', tmpmatch.result_shape(img_pyr.shape, template.shape), np.float32)
+    return [tmpmatch.best_score(tmpmatch.template_matching(img_pyr, template, meth, result=result)[0], meth)
+            for meth in tmpmatch.MATCHING_METHODS]
+
+
+def images(rows, cols, count, seed=0):
+    """Yield count random preprocessed-like images, sizes vary by up to 10% (like cropped scans)."""
+    rng = np.random.RandomState(seed)
+    base = cv.GaussianBlur(rng.randint(0, 256, (rows, cols)).astype(np.uint8), (9, 9), 3)
+    for _ in range(count):
+        r, c = rows - rng.randint(0, rows // 10), cols - rng.randint(0, cols // 10)
+        yield np.ascontiguousarray(base[:r, :c])
+
+
+def run_mode(mode, rows, cols, count):
+    """Match all images in the given mode, return the timings, memory and scores as dict."""
+    template = next(images(rows, cols, 1, seed=1))[100:100 + TEMPLATE_SIZE, 100:100 + TEMPLATE_SIZE].copy()
+    workspace = tmpmatch.MatchWorkspace()
+    match = match_original if mode == 'original' else lambda i, t: match_workspace(i, t, workspace)
+
+    # warm-up (first allocations of the workspace, lazy initializations of OpenCV)
+    match(next(images(rows, cols, 1)), template)
+
+    tracemalloc.start()
+    traced_peaks, seconds, scores = [], 0, []
+    for img in images(rows, cols, count):
+        tracemalloc.reset_peak() if hasattr(tracemalloc, 'reset_peak') else tracemalloc.clear_traces()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        scores.append([float(score) for score in match(img, template)])
+        seconds += time.perf_counter() - start
+        traced_peaks.append(tracemalloc.get_traced_memory()[1] - before)
+    tracemalloc.stop()
+
+    return {'ms': seconds / count * 1000, 'traced_median_mib': float(np.median(traced_peaks)) / 2 ** 20,
+            'traced_max_mib': max(traced_peaks) / 2 ** 20,
+            'max_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'workspace_allocations': workspace.allocations, 'scores': scores}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--size', default='400x450', help='size (rows x cols) of the biggest preprocessed image')
+    parser.add_argument('--count', type=int, default=200, help='number of images matched')
+    parser.add_argument('--mode', choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    rows, cols = (int(n) for n in args.size.lower().split('x'))
+
+    if args.mode is not None:
+        # child process of a single mode
+        print(json.dumps(run_mode(args.mode, rows, cols, args.count)))
+        return
+
+    results = {}
+    for mode in MODES:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--size', args.size,
+                                          '--count', str(args.count), '--mode', mode])
+        results[mode] = json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+    print('{:<12}{:>10}{:>20}{:>17}{:>14}{:>13}'.format('mode', 'ms/image', 'traced median MiB', 'traced max MiB',
+                                                        'max RSS MiB', 'allocations'))
+    for mode in MODES:
+        r = results[mode]
+        print('{:<12}{:>10.2f}{:>20.2f}{:>17.2f}{:>14.1f}{:>13}'.format(mode, r['ms'], r['traced_median_mib'],
+                                                                        r['traced_max_mib'], r['max_rss_mib'],
+                                                                        r['workspace_allocations']))
+
+    identical = results['original']['scores'] == results['workspace']['scores']
+    print('\nscores identical: {}'.format(identical))
+    if not identical:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -50,7 +50,7 @@ def main():
         # opened_eq = cv.morphologyEx(eq, cv.MORPH_OPEN, kernel)
         # plot_original_and_processed(eq, opened_eq, 'opened_eq')
 
-        res, img = tmpmatch.template_matching(img_denois, template)
+        res, img = tmpmatch.template_matching(img_denois, template, draw=True)
 
         min_val = np.amin(res)
 
@@ -0,0 +1,108 @@
+"""
+Cache module for OCT image SRF detection.
+
+Persistent on-disk cache for preprocessed images, so that expensive preprocessing (especially the non-local
+means denoising) is only performed once per image and preprocessing setting.
+
+Every entry is stored as a .npy file named after a key combining the hash of the image file content, the
+ordered list of preprocessing methods and the denoise strength. Entries are loaded memory-mapped. The total
+size of the cache is capped, least recently used entries are evicted first.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import uuid
+import hashlib
+import numpy as np
+
+
+DEFAULT_CACHE_DIR = '.preproc_cache'
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3  # 2 GiB
+
+
+def file_hash(path):
+    """Return the sha1 hex digest of the content of the given file."""
+    sha = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def cache_key(image_hash, preprocessing_methods, denoise_strength):
+    """Build the cache key of an image for the given preprocessing settings.
+
+    :param image_hash: content hash of the image file (see file_hash())
+    :param preprocessing_methods: ordered list of preprocessing method names (strings)
+    :param denoise_strength: integer denoise strength used during preprocessing
+    :return: key as hex string
+    """
+    setting = '{}|{}|{}'.format(image_hash, ','.join(preprocessing_methods), denoise_strength)
+    return hashlib.sha1(setting.encode('utf-8')).hexdigest()
+
+
+def load(cache_dir, key):
+    """Return the cached array (memory-mapped, read-only) for the given key or None if it is not cached."""
+    path = os.path.join(cache_dir, key + '.npy')
+    try:
+        arr = np.load(path, mmap_mode='r')
+        # refresh the modification time, which is used as 'last used' time for the LRU eviction
+        os.utime(path)
+    except (OSError, ValueError):
+        return None
+    return arr
+
+
+def store(cache_dir, key, arr, max_bytes=DEFAULT_MAX_BYTES):
+    """Save the array under the given key and evict old entries if the cache grew over max_bytes."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, key + '.npy')
+
+    # write to a temporary file first, so that concurrent processes never read a partially written entry
+    tmp_path = os.path.join(cache_dir, '{}.{}.tmp'.format(key, uuid.uuid4().hex))
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(arr))
+    os.replace(tmp_path, path)
+
+    evict(cache_dir, max_bytes)
+
+
+def evict(cache_dir, max_bytes=DEFAULT_MAX_BYTES):
+    """Delete the least recently used entries until the total size of the cache is at most max_bytes."""
+    if not os.path.isdir(cache_dir):
+        return
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith('.npy'):
+            try:
+                stat = entry.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:  # already removed by another process
+            pass
+        total -= size
+
+
+def clear(cache_dir=DEFAULT_CACHE_DIR):
+    """Remove all entries of the cache."""
+    evict(cache_dir, 0)
@@ -0,0 +1,126 @@
+"""
+Checkpoint module for OCT image SRF detection.
+
+Resumable batch runs: the score of every matched image is appended to an on-disk manifest (JSONL, one record
+per line) as soon as it is available, keyed by the hash of the image content and of the settings that determine
+the score. Restarted runs skip all images which already have a score for the same settings.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import json
+import hashlib
+import numpy as np
+import oct_cache as cache
+import oct_template_matching as tmpmatch
+
+
+def settings_key(template, preprocessing_methods, matching_method, denoise_strength, scales=None, roi_band=None,
+                 coarse_to_fine=False):
+    """Build the key of all settings which determine the score of an image.
+
+    The denoise strength only counts if a denoising method is used, the matching backend is not part of the key
+    since all backends produce the same scores.
+
+    :param template: template as uint8 np array
+    :param preprocessing_methods: ordered list of preprocessing method names (strings)
+    :param matching_method: template matching method
+    :param denoise_strength: integer denoise strength used during preprocessing
+    :param scales: list of pyramid scale factors matched separately, None for the pyramid() mosaic
+    :param roi_band: band (above, below) around the RPE which is matched, None for the whole image
+    :param coarse_to_fine: whether the pyramid levels are searched coarse to fine
+    :return: key as hex string
+    """
+    if not {'opening', 'nonloc', 'nonloc_fast'} & set(preprocessing_methods):
+        denoise_strength = 0
+
+    sha = hashlib.sha1()
+    sha.update(str(template.shape).encode('utf-8'))
+    sha.update(np.ascontiguousarray(template).tobytes())
+    setting = '{}|{}|{}|{}'.format(','.join(preprocessing_methods), denoise_strength, matching_method,
+                                   None if scales is None else ','.join(str(round(s, 6)) for s in scales))
+    if roi_band is not None:
+        # only part of the key if given, so that the keys of earlier runs stay valid
+        setting += '|roi={},{}'.format(*roi_band)
+    if coarse_to_fine:
+        setting += '|coarse_to_fine'
+    sha.update(setting.encode('utf-8'))
+    return sha.hexdigest()
+
+
+def load_manifest(manifest_path):
+    """Load all records of the manifest.
+
+    :return: dict mapping (image hash, settings key) to the score. Lines which cannot be parsed
+        (e.g. the last line of an interrupted run) are ignored.
+    """
+    scores = {}
+    if not os.path.isfile(manifest_path):
+        return scores
+
+    with open(manifest_path) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                scores[(record['image_hash'], record['settings'])] = record['score']
+            except (ValueError, KeyError):
+                continue
+
+    return scores
+
+
+def run_checkpointed(image_paths, template, preprocessing_methods, matching_method, denoise_strength, manifest_path,
+                     n_workers=1, cache_dir=None, scales=None, backend='opencv', roi_band=None,
+                     coarse_to_fine=False):
+    """Like oct_template_matching.run_matching(), but resumable with a checkpoint manifest.
+
+    Images which already have a score for the same settings in the manifest are skipped, the scores of all
+    other images are appended to the manifest as soon as they are matched.
+
+    :param image_paths: list of image paths
+    :param template: template as uint8 np array (see oct_template_matching.build_template())
+    :param preprocessing_methods: list of preprocessing method names (strings)
+    :param matching_method: template matching method
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param manifest_path: path of the JSONL manifest (created if it does not exist)
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image
+    :param coarse_to_fine: search every scale coarse to fine instead of exhaustively
+    :return: list of best matching score for each image (in the order of image_paths), NaN for images
+        which could not be processed (those are not recorded and retried in the next run)
+    """
+    settings = settings_key(template, preprocessing_methods, matching_method, denoise_strength, scales, roi_band,
+                            coarse_to_fine)
+    done = load_manifest(manifest_path)
+
+    image_hashes = {i: cache.file_hash(i) for i in image_paths}
+    todo = [i for i in image_paths if (image_hashes[i], settings) not in done]
+    print('\n{} of {} images already scored, {} to go.'.format(len(image_paths) - len(todo), len(image_paths),
+                                                                len(todo)))
+
+    with open(manifest_path, 'a') as f:
+        for i, score in tmpmatch.iter_matching(todo, template, preprocessing_methods, matching_method,
+                                               denoise_strength, n_workers, cache_dir, scales, backend, roi_band,
+                                               coarse_to_fine):
+            if np.isnan(score):
+                continue
+            record = {'image': i, 'image_hash': image_hashes[i], 'settings': settings, 'score': float(score)}
+            f.write(json.dumps(record) + '\n')
+            f.flush()
+            done[(image_hashes[i], settings)] = float(score)
+
+    return [done.get((image_hashes[i], settings), np.nan) for i in image_paths]
@@ -16,24 +16,28 @@ __copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All r
 __email__ = "dominik.meise@students.unibe.ch"
 
 
+import os
 import csv
 import glob
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-from sklearn import metrics
 import oct_template_matching as tmpmatch
 
-matplotlib.rcParams['image.cmap'] = 'gray'
 
-
-def evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength):
+def evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength, n_workers=1,
+                       cache_dir=None, roi_band=None, coarse_to_fine=False, checkpoint_path=None):
     """Determine the optimal threshold based on the given preprocessing and matching methods and the template used.
 
     :param template_path: Filepath of the template used for matching
     :param preproc_methods: list of strings of the used preprocessing methods
     :param matching_method: method used for template matching
     :param denoise_strength: integer value which set the degree of denoising applied during preprocessing
+    :param n_workers: number of worker processes used for matching the train-data
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image
+    :param coarse_to_fine: search every scale coarse to fine instead of exhaustively
+    :param checkpoint_path: manifest of scored images (see oct_checkpoint.py) for an incremental evaluation: only
+        images without a score for these settings (new or changed images) are matched, the scores of all others are
+        read from the manifest. None to match all images.
     :return: prec: highest precision achieved for the defined range of thresholds for the available train-data
              auc: area under the curve value for the defined range of thresholds
              thresh: the threshold value which achieved the highest precision for the available train-data
@@ -46,22 +50,31 @@ def evaluate_threshold(template_path, preproc_methods, matching_method, denoise_
     setting_string = '_'.join(preproc_methods) + '_' + str(denoise_strength) + \
                      '_' + matching_method
 
-    # run on all srf images
-    best_scores_srf = tmpmatch.run_matching(images_srf, template_path, preproc_methods,
-                                            matching_method, denoise_strength)
-    # run on all non-srf images
-    best_scores_no = tmpmatch.run_matching(images_no, template_path, preproc_methods,
-                                           matching_method, denoise_strength)
+    if checkpoint_path is not None:
+        # the scores are keyed by image hash and settings (see oct_checkpoint.settings_key()), so other settings
+        # in the manifest are left untouched and only new or changed images are matched
+        import oct_checkpoint as checkpoint
+        template = tmpmatch.build_template(template_path, preproc_methods, denoise_strength, cache_dir)
+        best_scores_srf = checkpoint.run_checkpointed(images_srf, template, preproc_methods, matching_method,
+                                                      denoise_strength, checkpoint_path, n_workers, cache_dir,
+                                                      roi_band=roi_band, coarse_to_fine=coarse_to_fine)
+        best_scores_no = checkpoint.run_checkpointed(images_no, template, preproc_methods, matching_method,
+                                                     denoise_strength, checkpoint_path, n_workers, cache_dir,
+                                                     roi_band=roi_band, coarse_to_fine=coarse_to_fine)
+    else:
+        # run on all srf images
+        best_scores_srf = tmpmatch.run_matching(images_srf, template_path, preproc_methods,
+                                                matching_method, denoise_strength, n_workers=n_workers,
+                                                cache_dir=cache_dir, roi_band=roi_band,
+                                                coarse_to_fine=coarse_to_fine)
+        # run on all non-srf images
+        best_scores_no = tmpmatch.run_matching(images_no, template_path, preproc_methods,
+                                               matching_method, denoise_strength, n_workers=n_workers,
+                                               cache_dir=cache_dir, roi_band=roi_band,
+                                               coarse_to_fine=coarse_to_fine)
 
     # testing range of thresholds
-    if 'NORMED' in matching_method:
-        low = 0
-        upp = 1
-        stp = 0.0001
-    else:
-        low = 0
-        upp = 10000000
-        stp = 1000
+    low, upp, stp = threshold_range(matching_method)
 
     # evaluate system for this set of settings
     prec, auc, thresh = eval_precision(low, upp, stp, best_scores_srf, best_scores_no,
@@ -77,8 +90,10 @@ def classify_by_threshold(threshold, scores, matching_method):
     :param scores: dissimilatiry or distance scores to classify
     :param matching_method: method used for template matching (determines which class lies on which side of the thresh)
     :return: list of same length as input with score values replaced by 0 or 1 depending on the classification
+             (images without a valid score, i.e. NaN, are classified as 0)
     """
-    img_classes = np.asarray(scores)
+    img_classes = np.asarray(scores, dtype=np.float64)
+    failed = np.isnan(img_classes)
 
     if 'SQDIFF' in matching_method:
         img_classes[img_classes <= threshold] = 1
@@ -86,6 +101,7 @@ def classify_by_threshold(threshold, scores, matching_method):
     else:
         img_classes[img_classes >= threshold] = 1
         img_classes[img_classes < threshold] = 0
+    img_classes[failed] = 0
 
     return img_classes.astype(int)
 
@@ -98,6 +114,39 @@ def write_csv(image_names, img_classes, filename):
         writer.writerows(zip(image_names, img_classes))
 
 
+def iter_classify(results, threshold, matching_method):
+    """Classify a stream of (image path, score) tuples (see oct_template_matching.iter_matching()).
+
+    :param results: iterable of (image path, score) tuples
+    :param threshold: given (ideally optimized) threshold to discriminate the two classes
+    :param matching_method: method used for template matching (see classify_by_threshold())
+    :return: generator of (image filename, score, label) tuples
+    """
+    for image_path, score in results:
+        label = classify_by_threshold(threshold, [score], matching_method)[0]
+        yield os.path.basename(image_path), score, label
+
+
+def write_csv_stream(rows, filename):
+    """Produce the csv output file from a stream of (image filename, score, label) tuples (see iter_classify()).
+
+    Every row is flushed to the file as soon as it arrives, so that the results survive an interruption.
+
+    :return: number of rows written
+    """
+    count = 0
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['filename', 'label'])
+        f.flush()
+        for name, _, label in rows:
+            writer.writerow([name, label])
+            f.flush()
+            count += 1
+
+    return count
+
+
 def eval_precision(low, upp, stp, min_dist_srf, min_dist_no, preproc_methods,
                    matching_method, setting_string='default', stdout=True):
     """Evaluate precision of the system for a range of thresholds.
@@ -113,41 +162,9 @@ def eval_precision(low, upp, stp, min_dist_srf, min_dist_no, preproc_methods,
     :param stdout: indicating if results should be written to stdout or saved as txt-file
     """
 
-    precisions = []
-    # iterating over all thresholds
-    for thresh in np.arange(low, upp, stp):
-        tp = 0
-        count = 0
-
-        # count how many srf images are correctly identified (above the threshold)
-        for i in min_dist_srf:
-            count += 1
-            if i >= thresh:
-                tp += 1
-
-        # count how many non-srf are correctly identified (below the threshold)
-        for i in min_dist_no:
-            count += 1
-            if i < thresh:
-                tp += 1
-
-        # If the method is TM_SQDIFF or TM_SQDIFF_NORMED,
-        # smaller scores are better, else larger score are better matching.
-        # Thus inverse true positives.
-        if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
-            tp = count - tp
-
-        precision = tp / count
-        precisions.append(precision)
-        # print(thresh, ':\t', precision, '% ', tp, '/', count)
-
-    best_prec = max(precisions)
-    thresh = np.arange(low, upp, stp)[np.argmax(precisions)]
-
-    # auc calculation
-    prec = sorted(precisions)
-    coord = np.arange(len(prec))*0.001
-    auc = metrics.auc(prec, coord)
+    thresholds = np.arange(low, upp, stp)
+    precisions = precision_curve(thresholds, min_dist_srf, min_dist_no, matching_method)
+    best_prec, auc, thresh = _summarize_curve(thresholds, precisions)
 
     if stdout:
         print('Best precision:' + str(best_prec))
@@ -155,7 +172,8 @@ def eval_precision(low, upp, stp, min_dist_srf, min_dist_no, preproc_methods,
         print('auc: ', auc)
 
     # plotting
-    plt.plot(np.arange(low, upp, stp), precisions)
+    plt = _pyplot()
+    plt.plot(thresholds, precisions)
     plt.xlabel('threshold ')
     plt.ylabel('precision')
     plt.title(', '.join(preproc_methods) + ', ' + matching_method +
@@ -172,6 +190,89 @@ def eval_precision(low, upp, stp, min_dist_srf, min_dist_no, preproc_methods,
     return best_prec, auc, thresh
 
 
+def threshold_range(matching_method):
+    """Return the range of thresholds (low, upp, stp) to test for the matching method (see eval_precision())."""
+    if 'NORMED' in matching_method:
+        return 0, 1, 0.0001
+    return 0, 10000000, 1000
+
+
+def score_precision(min_dist_srf, min_dist_no, matching_method):
+    """Evaluate precision like eval_precision() over the default threshold range, but without plotting.
+
+    Used where many settings (or subsets of the images) are compared, e.g. by the tuner in 'oct_tuning.py'.
+
+    :return: prec, auc, thresh (see eval_precision())
+    """
+    thresholds = np.arange(*threshold_range(matching_method))
+    precisions = precision_curve(thresholds, min_dist_srf, min_dist_no, matching_method)
+    return _summarize_curve(thresholds, precisions)
+
+
+def score_precision_store(store_dir, settings_id, matching_method):
+    """Evaluate precision like score_precision() on the labelled images of a score store (see oct_score_store.py).
+
+    No image is loaded, the scores of the settings are read from the memory-mapped store.
+
+    :param store_dir: directory of the score store
+    :param settings_id: settings id of the scores (as returned by oct_score_store.score_images())
+    :param matching_method: matching method (score column of the store)
+    :return: prec, auc, thresh (see eval_precision())
+    """
+    import oct_score_store as store
+    scores, labels = store.select(store_dir, settings_id, matching_method)
+    return score_precision(scores[labels == store.LABEL_SRF], scores[labels == store.LABEL_NO_SRF], matching_method)
+
+
+def _summarize_curve(thresholds, precisions):
+    """Return the best precision, the auc and the threshold of the best precision of a precision curve."""
+    best_prec = np.amax(precisions)
+    thresh = thresholds[np.argmax(precisions)]
+
+    # auc calculation
+    from sklearn import metrics
+    prec = sorted(precisions)
+    coord = np.arange(len(prec))*0.001
+    auc = metrics.auc(prec, coord)
+
+    return best_prec, auc, thresh
+
+
+def precision_curve(thresholds, scores_srf, scores_no, matching_method):
+    """Return the precision of the system for each of the given thresholds.
+
+    Instead of comparing every score against every threshold, the scores are sorted once and the number of
+    scores above/below each threshold is looked up with a binary search, i.e. O((n + T) log n).
+
+    :param thresholds: np array of thresholds
+    :param scores_srf: list of best matching scores of each SRF image
+    :param scores_no: list of best matching scores of each non-SRF image
+    :param matching_method: matching method name (string)
+    :return: np array of precisions, same length as thresholds
+    """
+    scores_srf = np.asarray(scores_srf, dtype=np.float64)
+    scores_no = np.asarray(scores_no, dtype=np.float64)
+    count = len(scores_srf) + len(scores_no)
+
+    # scores of images which could not be processed (NaN) are left out of the comparisons, but count towards the
+    # total, i.e. such images are misclassified for every threshold and matching method
+    srf_sorted = np.sort(scores_srf[~np.isnan(scores_srf)])
+    no_sorted = np.sort(scores_no[~np.isnan(scores_no)])
+
+    # srf images are correctly identified if their score is above (or equal to) the threshold,
+    # non-srf images if their score is below the threshold
+    tp = len(srf_sorted) - np.searchsorted(srf_sorted, thresholds, side='left')
+    tp += np.searchsorted(no_sorted, thresholds, side='left')
+
+    # If the method is TM_SQDIFF or TM_SQDIFF_NORMED,
+    # smaller scores are better, else larger score are better matching.
+    # Thus inverse true positives (of the images with a valid score).
+    if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+        tp = len(srf_sorted) + len(no_sorted) - tp
+
+    return tp / count
+
+
 def sort_result_and_save_as_txt(result):
     """Sorting dict by value and then saving as a txt-file."""
     with open('results.txt', 'w') as f:
@@ -182,6 +283,7 @@ def sort_result_and_save_as_txt(result):
 
 def plot_original_and_processed(original, processed, process_title=''):
     """Plotting two images side by side for comparison."""
+    plt = _pyplot()
     fig, axs = plt.subplots(1, 2)
 
     axs[0].imshow(original)
@@ -190,3 +292,12 @@ def plot_original_and_processed(original, processed, process_title=''):
     axs[1].set_title(process_title)
 
     plt.show()
+
+
+def _pyplot():
+    """Import and configure pyplot on first use, so that matplotlib is only loaded if something is plotted."""
+    import matplotlib
+    import matplotlib.pyplot as plt
+
+    matplotlib.rcParams['image.cmap'] = 'gray'
+    return plt
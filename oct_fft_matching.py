@@ -0,0 +1,176 @@
+"""
+FFT template matching module for OCT image SRF detection.
+
+Template matching backend computing the same scores as cv.matchTemplate (all six cv.TM_* methods), but
+by cross-correlation in the frequency domain. The FFT and the integral images of an image are computed
+once and reused for all templates (and matching methods) matched against it, which pays off as soon as
+more than one template or method is matched against the same image.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import numpy as np
+
+
+FLT_EPSILON = np.finfo(np.float32).eps
+
+
+class SpectralImage(object):
+    """Gray-scale image with precomputed FFT and integral images, to be matched against several templates."""
+
+    def __init__(self, image):
+        # scipy is only imported once the fft backend is actually used
+        from scipy.fftpack import next_fast_len
+
+        self.image = np.asarray(image, dtype=np.float64)
+        rows, cols = self.image.shape
+        # circular correlation does not wrap around in the valid region, so no padding to the full size is needed
+        self.fft_shape = (next_fast_len(rows), next_fast_len(cols))
+        self.spectrum = np.fft.rfft2(self.image, self.fft_shape)
+
+        # integral images (with a leading row and column of zeros) for the window sums
+        self.integral = np.zeros((rows + 1, cols + 1))
+        self.integral[1:, 1:] = self.image.cumsum(axis=0).cumsum(axis=1)
+        self.integral_sq = np.zeros((rows + 1, cols + 1))
+        self.integral_sq[1:, 1:] = (self.image ** 2).cumsum(axis=0).cumsum(axis=1)
+
+        self._template_spectra = {}
+
+    def correlate(self, template):
+        """Return the valid cross-correlation of the image and the template (cv.TM_CCORR)."""
+        rows, cols = self.image.shape
+        t_rows, t_cols = template.shape
+
+        # the spectrum of a template only depends on the fft size, so it is reused for same sized images
+        # (the template itself is kept with its spectrum, so that its id cannot be reused by another array)
+        key = (id(template), self.fft_shape)
+        if key not in self._template_spectra or self._template_spectra[key][0] is not template:
+            spectrum = np.conj(np.fft.rfft2(np.asarray(template, dtype=np.float64), self.fft_shape))
+            self._template_spectra[key] = (template, spectrum)
+
+        corr = np.fft.irfft2(self.spectrum * self._template_spectra[key][1], self.fft_shape)
+        return corr[:rows - t_rows + 1, :cols - t_cols + 1]
+
+    def window_sums(self, t_rows, t_cols):
+        """Return the sum and the sum of squares of the image over every window of the given size."""
+        return _window_sum(self.integral, t_rows, t_cols), _window_sum(self.integral_sq, t_rows, t_cols)
+
+
+def match_template(image, template, meth='cv.TM_SQDIFF'):
+    """Match the template against the image, equivalent to cv.matchTemplate(image, template, eval(meth)).
+
+    :param image: gray-scale image (np array or SpectralImage)
+    :param template: gray-scale template
+    :param meth: template matching method. Available:
+        'cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED', 'cv.TM_CCORR',
+        'cv.TM_CCORR_NORMED', 'cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED'
+    :return: the distance map of the template matching the input image (float32)
+    """
+    return match_methods(image, template, [meth])[0]
+
+
+def match_templates(image, templates, meth='cv.TM_SQDIFF'):
+    """Match many templates against one image, the FFT of the image is computed only once."""
+    image = _as_spectral(image)
+    return [match_template(image, template, meth) for template in templates]
+
+
+def match_images(images, template, meth='cv.TM_SQDIFF'):
+    """Match one template against many images, the FFT of the template is computed once per image size."""
+    template_spectra = {}
+    results = []
+    for image in images:
+        image = _as_spectral(image)
+        # share the template spectra between the images
+        image._template_spectra = template_spectra
+        results.append(match_template(image, template, meth))
+    return results
+
+
+def match_methods(image, template, methods):
+    """Match the template against the image with several methods, the correlation is computed only once.
+
+    :param image: gray-scale image (np array or SpectralImage)
+    :param template: gray-scale template
+    :param methods: list of template matching methods (see match_template())
+    :return: list of distance maps, one per method
+    """
+    image = _as_spectral(image)
+    t_rows, t_cols = np.shape(template)
+    if image.image.shape[0] < t_rows or image.image.shape[1] < t_cols:
+        raise ValueError('Template is bigger than the image!')
+
+    area = t_rows * t_cols
+    templ = np.asarray(template, dtype=np.float64)
+    templ_sum = templ.sum()
+    templ_sum2 = (templ ** 2).sum()
+    templ_mean = templ_sum / area
+    templ_var = max(templ_sum2 - templ_sum * templ_mean, 0)
+
+    ccorr = image.correlate(template)
+    wnd_sum, wnd_sum2 = image.window_sums(t_rows, t_cols)
+
+    results = []
+    for meth in methods:
+        if meth in ['cv.TM_CCORR', 'cv.TM_CCORR_NORMED']:
+            num = ccorr
+            wnd_mean2 = 0
+            templ_norm = np.sqrt(templ_sum2)
+        elif meth in ['cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED']:
+            if meth == 'cv.TM_CCOEFF_NORMED' and templ_var / area < np.finfo(np.float64).eps:
+                # constant template, same convention as OpenCV
+                results.append(np.ones(ccorr.shape, dtype=np.float32))
+                continue
+            num = ccorr - wnd_sum * templ_mean
+            wnd_mean2 = wnd_sum ** 2 / area
+            templ_norm = np.sqrt(templ_var)
+        elif meth in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+            num = np.maximum(wnd_sum2 - 2 * ccorr + templ_sum2, 0)
+            wnd_mean2 = 0
+            templ_norm = np.sqrt(templ_sum2)
+        else:
+            raise ValueError('Unknown matching method {}!'.format(meth))
+
+        if meth.endswith('_NORMED'):
+            num = _normalize(num, wnd_sum2, wnd_mean2, templ_norm, meth == 'cv.TM_SQDIFF_NORMED')
+
+        results.append(num.astype(np.float32))
+
+    return results
+
+
+def _normalize(num, wnd_sum2, wnd_mean2, templ_norm, sqdiff):
+    """Normalize the scores by the window and template norms, handling flat windows like OpenCV does."""
+    diff2 = np.maximum(wnd_sum2 - wnd_mean2, 0)
+    t = np.sqrt(diff2) * templ_norm
+    # avoid rounding errors on (almost) constant windows
+    t[diff2 <= np.minimum(0.5, 10 * FLT_EPSILON * wnd_sum2)] = 0
+
+    abs_num = np.abs(num)
+    out = np.divide(num, t, out=np.full(num.shape, 1.0 if sqdiff else 0.0), where=abs_num < t)
+    # scores slightly out of [-1, 1] due to rounding are clipped
+    clip = (abs_num >= t) & (abs_num < t * 1.125)
+    out[clip] = np.sign(num[clip])
+    return out
+
+
+def _window_sum(integral, t_rows, t_cols):
+    """Sum over every t_rows x t_cols window, from an integral image with a leading zero row and column."""
+    return (integral[t_rows:, t_cols:] - integral[:-t_rows, t_cols:]
+            - integral[t_rows:, :-t_cols] + integral[:-t_rows, :-t_cols])
+
+
+def _as_spectral(image):
+    if isinstance(image, SpectralImage):
+        return image
+    return SpectralImage(image)
@@ -0,0 +1,68 @@
+"""
+OCT image SRF detection inference module.
+
+Classification of new OCT images with a calibrated model (see calibrate() in 'oct_srf_detection.py'),
+without re-scoring the training data and without any plotting.
+
+Usage:
+    python oct_inference.py [model_path] [image_dir] [result_filename] [n_workers] [cache_dir]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import oct_model as model
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+
+
+DEFAULT_MODEL_PATH = 'srf_model.npz'
+
+
+def main(model_path=DEFAULT_MODEL_PATH, image_dir='Test-Data/handout',
+         result_filename='project_Waelchli_Moser_Meise.csv', n_workers=None, cache_dir=None):
+    """Classify all images of the directory with the given model and write the results to the csv file.
+
+    :param model_path: path of the model file (see oct_model.save_model())
+    :param image_dir: directory of the images to classify
+    :param result_filename: output csv file
+    :param n_workers: number of worker processes used for matching (default: all CPU cores)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None (or '') disables caching
+    """
+    # the arguments can be given on the command line as strings
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = int(n_workers)
+    cache_dir = cache_dir or None
+
+    srf_model = model.load_model(model_path)
+    print('Loaded model {} (threshold: {}, preprocessing methods: {}, denoise strength: {}, matching method: {})'
+          .format(model_path, round(srf_model['threshold'], 3), srf_model['preproc_methods'],
+                  srf_model['denoise_strength'], srf_model['matching_method']))
+
+    # only the labels are written, so a coarse to fine search can stop as soon as the threshold is crossed
+    results = tmpmatch.iter_matching(preproc.iter_image_paths(image_dir), srf_model['template'],
+                                     srf_model['preproc_methods'], srf_model['matching_method'],
+                                     srf_model['denoise_strength'], n_workers, cache_dir, srf_model['scales'],
+                                     roi_band=srf_model['roi_band'], coarse_to_fine=srf_model['coarse_to_fine'],
+                                     stop_at=srf_model['threshold'])
+    rows = ((os.path.basename(image_path), score, model.classify(srf_model, [score])[0])
+            for image_path, score in results)
+    count = evaluate.write_csv_stream(rows, result_filename)
+    print('\nSaved results of {} images in {}...'.format(count, result_filename))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:])
@@ -0,0 +1,82 @@
+"""
+Model module for OCT image SRF detection.
+
+Saving and loading of a calibrated model: everything needed to classify new images (preprocessing and matching
+settings, the preprocessed template, the optimized threshold and the score direction) in a single .npz file,
+so that inference does not need the training data.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import json
+import numpy as np
+
+
+def save_model(model_path, template, preproc_methods, matching_method, denoise_strength, threshold,
+               precision=None, auc=None, scales=None, roi_band=None, coarse_to_fine=False):
+    """Save a calibrated model as .npz file.
+
+    :param model_path: path of the model file
+    :param template: preprocessed template as uint8 np array
+    :param preproc_methods: list of preprocessing method names (strings)
+    :param matching_method: template matching method
+    :param denoise_strength: integer denoise strength used during preprocessing
+    :param threshold: optimized threshold to discriminate the two classes
+    :param precision: precision achieved on the train-data with this threshold (for reference only)
+    :param auc: area under the curve on the train-data (for reference only)
+    :param scales: list of pyramid scale factors matched separately, None for the pyramid() mosaic
+    :param roi_band: band (above, below) around the RPE which is matched, None for the whole image
+    :param coarse_to_fine: whether the pyramid levels are searched coarse to fine
+    """
+    settings = {
+        'preproc_methods': list(preproc_methods),
+        'matching_method': matching_method,
+        'denoise_strength': int(denoise_strength),
+        'scales': None if scales is None else [float(s) for s in scales],
+        'roi_band': None if roi_band is None else [int(b) for b in roi_band],
+        'coarse_to_fine': bool(coarse_to_fine),
+        'threshold': float(threshold),
+        # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, smaller scores are better
+        'higher_is_better': matching_method not in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED'],
+        'precision': None if precision is None else float(precision),
+        'auc': None if auc is None else float(auc),
+    }
+    with open(model_path, 'wb') as f:
+        np.savez(f, template=template, settings=json.dumps(settings))
+
+
+def load_model(model_path):
+    """Load a model saved with save_model().
+
+    :return: dict of the settings (see save_model()) with the template under the key 'template'
+    """
+    with np.load(model_path, allow_pickle=False) as data:
+        model = json.loads(str(data['settings']))
+        model['template'] = data['template']
+    # models saved before these settings existed match the whole image exhaustively
+    model.setdefault('roi_band', None)
+    model.setdefault('coarse_to_fine', False)
+    return model
+
+
+def classify(model, scores):
+    """Classify the scores with the threshold and score direction of the model.
+
+    :return: np array of 0 or 1 for each score (images without a valid score, i.e. NaN, are classified as 0)
+    """
+    scores = np.asarray(scores, dtype=np.float64)
+    if model['higher_is_better']:
+        labels = scores >= model['threshold']
+    else:
+        labels = scores <= model['threshold']
+    return labels.astype(int)
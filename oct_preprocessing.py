@@ -16,23 +16,159 @@ __copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All r
 __email__ = "dominik.meise@students.unibe.ch"
 
 
+import os
+import csv
+import glob
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import cv2 as cv
-from skimage import io, color, exposure
-from skimage.filters import threshold_otsu, gaussian
+import oct_cache as cache
+import oct_profiling as profiling
+
+
+# weights of skimage's color.rgb2gray (order r, g, b)
+RGB2GRAY_COEFFS = np.array([0.2125, 0.7154, 0.0721])
+
+
+def _rgb2gray_uint8(rgb):
+    """Return (color.rgb2gray(rgb) * 255).astype(np.uint8) for uint8 rgb images, computed the same way without skimage.
+
+    Note that this is not the identity for gray values (r = g = b): the float rounding and the truncating cast
+    map some of them to the next lower value. Results are kept identical to the original conversion.
+    """
+    return ((rgb * (1. / 255) @ RGB2GRAY_COEFFS) * 255).astype(np.uint8)
+
+
+# conversion of every gray value (r = g = b) as look up table
+GRAY_LUT = _rgb2gray_uint8(np.repeat(np.arange(256, dtype=np.uint8), 3).reshape(1, 256, 3)).reshape(256)
 
 
 def load_img_as_gray(img_path):
-    """Read in rgb image and convert it to gray-scale 0-255 uint8 np array."""
-    img = io.imread(img_path)
-    return (color.rgb2gray(img) * 255).astype(np.uint8)
+    """Read in rgb image and convert it to gray-scale 0-255 uint8 np array.
+
+    The image is decoded directly as uint8. Since the oct images are gray values stored as rgb(a), only one channel
+    is converted by a look up table, without any float intermediates. The result is identical to the former
+    (color.rgb2gray(io.imread(img_path)) * 255).astype(np.uint8).
+    """
+    img = cv.imread(img_path, cv.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError('Cannot read image {}!'.format(img_path))
+    return _to_gray(img)
+
+
+def decode_img_as_gray(data):
+    """Decode an encoded (e.g. png) rgb image from bytes and convert it like load_img_as_gray()."""
+    img = cv.imdecode(np.frombuffer(data, dtype=np.uint8), cv.IMREAD_UNCHANGED)
+    if img is None:
+        raise ValueError('Cannot decode image!')
+    return _to_gray(img)
+
 
+def _to_gray(img):
+    """Convert an image decoded by OpenCV (gray, BGR or BGRA, uint8) to gray-scale like load_img_as_gray()."""
+    if img.dtype != np.uint8:
+        raise ValueError('Only 8 bit images are supported!')
+    if img.ndim == 2:
+        return img
 
-def load_preproc_template(preproc_methods, denoise_strength):
+    blue = img[..., 0]
+    if np.array_equal(blue, img[..., 1]) and np.array_equal(blue, img[..., 2]):
+        # gray image stored as rgb(a), the alpha channel is ignored (like rgb2gray does)
+        return cv.LUT(np.ascontiguousarray(blue), GRAY_LUT)
+
+    # real color image: OpenCV decodes to BGR(A), the weights are in rgb order
+    return _rgb2gray_uint8(img[..., 2::-1])
+
+
+def iter_image_paths(directory, extension='.png'):
+    """Lazily yield the paths of all images in the directory (in arbitrary order, without listing it up front)."""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_file() and entry.name.lower().endswith(extension):
+                yield entry.path
+
+
+# image and region (top, bottom, left, right) of the preprocessed image the default template is cut from
+DEFAULT_TEMPLATE = ('Train-Data/SRF/input_1492_1.png', 100, 140, 300, 340)
+
+# patch and search window sizes of the non-local means denoising (OpenCV's defaults)
+NONLOC_TEMPLATE_WINDOW = 7
+NONLOC_SEARCH_WINDOW = 21
+
+
+def load_preproc_template(preproc_methods, denoise_strength, cache_dir=None):
     """Create template from fixed region of the first train-data srf image, but with the given preprocessing applied."""
-    tmpl = load_img_as_gray('Train-Data/SRF/input_1492_1.png')
-    tmpl = perform_bulk_perproc(tmpl, preproc_methods, denoise_strength)
-    return tmpl[100:140, 300:340]
+    return cut_preproc_template(*DEFAULT_TEMPLATE, preproc_methods, denoise_strength, cache_dir)
+
+
+def cut_preproc_template(img_path, top, bottom, left, right, preproc_methods, denoise_strength, cache_dir=None):
+    """Create template from the given region of an image, with the given preprocessing applied to the whole image."""
+    tmpl = load_and_preproc(img_path, preproc_methods, denoise_strength, cache_dir)
+    return np.array(tmpl[top:bottom, left:right])
+
+
+def load_template_bank(source, preproc_methods, denoise_strength, cache_dir=None):
+    """Load a bank of templates, which are all matched at once (see oct_template_matching.run_matching_bank()).
+
+    :param source: either a directory, every image in it is used as a template as is (like a manually specified
+        template), or a csv manifest with the columns 'path,top,bottom,left,right'. For manifest rows with a region,
+        the template is cut from that region of the image after the preprocessing was applied (like the default
+        template), rows without a region use the image as is.
+    :param preproc_methods: list of preprocessing method names (strings)
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :return: list of template names and list of templates (uint8 np arrays)
+    """
+    names = []
+    templates = []
+
+    if os.path.isdir(source):
+        for path in sorted(glob.glob(os.path.join(source, '*.png'))):
+            names.append(os.path.basename(path))
+            templates.append(load_img_as_gray(path))
+        return names, templates
+
+    # paths in the manifest are relative to the manifest itself
+    base_dir = os.path.dirname(source)
+    with open(source, newline='') as f:
+        for row in csv.DictReader(f):
+            path = os.path.join(base_dir, row['path'])
+            region = [row.get(key) for key in ['top', 'bottom', 'left', 'right']]
+            if all(region):
+                top, bottom, left, right = (int(value) for value in region)
+                names.append('{}[{}:{}, {}:{}]'.format(row['path'], top, bottom, left, right))
+                templates.append(cut_preproc_template(path, top, bottom, left, right, preproc_methods,
+                                                      denoise_strength, cache_dir))
+            else:
+                names.append(row['path'])
+                templates.append(load_img_as_gray(path))
+
+    return names, templates
+
+
+def load_and_preproc(img_path, preprocessing_methods, denoise_strength, cache_dir=None,
+                     max_cache_bytes=cache.DEFAULT_MAX_BYTES):
+    """Load an image as gray-scale and perform all specified preprocessing steps (see perform_bulk_perproc()).
+
+    :param img_path: path of the image
+    :param preprocessing_methods: list of preprocessing method names (strings)
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param cache_dir: directory of the on-disk cache for preprocessed images (see oct_cache.py), None disables caching
+    :param max_cache_bytes: size limit of the cache, least recently used entries are evicted first
+    :return: processed image (read-only and memory-mapped if it was loaded from the cache)
+    """
+    if cache_dir is None:
+        return perform_bulk_perproc(profiling.call('load', load_img_as_gray, img_path), preprocessing_methods,
+                                    denoise_strength)
+
+    key = cache.cache_key(cache.file_hash(img_path), preprocessing_methods, denoise_strength)
+    img = profiling.call('cache_load', cache.load, cache_dir, key)
+    if img is None:
+        img = perform_bulk_perproc(profiling.call('load', load_img_as_gray, img_path), preprocessing_methods,
+                                   denoise_strength)
+        cache.store(cache_dir, key, img, max_cache_bytes)
+
+    return img
 
 
 def perform_bulk_perproc(image, preprocessing_methods, denoise_strength):
@@ -40,39 +176,175 @@ def perform_bulk_perproc(image, preprocessing_methods, denoise_strength):
 
     :param image: original unprocessed image
     :param preprocessing_methods: list of preprocessing method names (strings). Available:
-        'crop', 'eq', 'opening', 'nonloc'
+        'crop', 'eq', 'opening', 'nonloc', 'nonloc_fast' (approximate non-local means on the half-sized image)
     :param denoise_strength: integer to specify how aggresively denoising should be applied.
-    :return: processed image
+    :return: processed image (the image itself or a view of it if no step produces a new image, e.g. only 'crop')
     """
-    img = image.copy()
+    # every step returns a new image (or a view), the original image is never modified and needs no copy
+    img = image
     if 'crop' in preprocessing_methods:
-        img = crop(img)
+        img = profiling.call('crop', crop, img)
     if 'eq' in preprocessing_methods:
-        img = hist_equalize(img)
+        img = profiling.call('eq', hist_equalize, img)
     if 'opening' in preprocessing_methods:
-        img = opening_denoising(img, kernel_size=denoise_strength)
+        img = profiling.call('opening', opening_denoising, img, kernel_size=denoise_strength)
     if 'nonloc' in preprocessing_methods:
-        img = nonloc_denoising(img, denoise_strength)
+        img = profiling.call('nonloc', nonloc_denoising, img, denoise_strength)
+    elif 'nonloc_fast' in preprocessing_methods:
+        img = profiling.call('nonloc_fast', nonloc_denoising, img, denoise_strength, fast=True)
 
     return img
 
 
+def perform_bulk_perproc_batch(images, preprocessing_methods, denoise_strength, n_threads=None):
+    """Perform all specified preprocessing steps (see perform_bulk_perproc()) on a batch of images.
+
+    The non-local means denoising, by far the slowest step, runs on a pool of threads over the whole batch.
+
+    Images of the same shape (e.g. from the same scanner) are stacked and processed by
+    perform_bulk_perproc_stack() instead.
+
+    :param images: list of original unprocessed images
+    :param n_threads: number of threads used for denoising (default: all CPU cores)
+    :return: list of processed images
+    """
+    if len(images) > 1 and all(img.shape == images[0].shape and img.dtype == np.uint8 for img in images):
+        return list(perform_bulk_perproc_stack(np.stack(images), preprocessing_methods, denoise_strength, n_threads))
+
+    per_image_methods = [m for m in preprocessing_methods if m not in ('nonloc', 'nonloc_fast')]
+    imgs = [perform_bulk_perproc(img, per_image_methods, denoise_strength) for img in images]
+    if 'nonloc' in preprocessing_methods:
+        imgs = nonloc_denoising_batch(imgs, denoise_strength, n_threads)
+    elif 'nonloc_fast' in preprocessing_methods:
+        imgs = nonloc_denoising_batch(imgs, denoise_strength, n_threads, fast=True)
+
+    return imgs
+
+
+def load_stack(image_paths, out=None):
+    """Load same-sized images as gray-scale into one contiguous (N, H, W) uint8 array.
+
+    :param image_paths: list of image paths, all images must have the same size
+    :param out: preallocated (N, H, W) uint8 array to load the images into (e.g. of a previous batch), None to
+        allocate it
+    :return: (N, H, W) uint8 array
+    """
+    for index, img_path in enumerate(image_paths):
+        img = profiling.call('load', load_img_as_gray, img_path)
+        if out is None:
+            out = np.empty((len(image_paths),) + img.shape, dtype=np.uint8)
+        if img.shape != out.shape[1:]:
+            raise ValueError('{} has the shape {}, expected {}!'.format(img_path, img.shape, out.shape[1:]))
+        out[index] = img
+
+    if out is None:
+        raise ValueError('Cannot load an empty stack of images!')
+    return out
+
+
+def perform_bulk_perproc_stack(stack, preprocessing_methods, denoise_strength, n_threads=None):
+    """Perform all specified preprocessing steps (see perform_bulk_perproc()) on a stack of same-sized images.
+
+    The steps run slice-wise from one preallocated buffer into another (two buffers for the whole stack, the stack
+    itself is not modified), the equalization lookup tables of all images are computed at once and the non-local
+    means denoising runs on a pool of threads. The results are the same as of perform_bulk_perproc().
+
+    Cropping makes the shapes ragged, since every image is cropped to its own bounding box. The cropped images
+    are views of the stack and the following steps write into the top left corner of the slices of buffers of
+    the biggest crop, so the result is a list of views of different shapes (rows and columns are not contiguous).
+
+    :param stack: (N, H, W) uint8 array of original unprocessed images (see load_stack())
+    :param preprocessing_methods: list of preprocessing method names (strings), see perform_bulk_perproc()
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param n_threads: number of threads used for the non-local means denoising (default: all CPU cores)
+    :return: (N, H, W) uint8 array of the processed images (the stack itself if there is no step),
+        list of N processed images if cropped
+    """
+    if stack.ndim != 3 or stack.dtype != np.uint8:
+        raise ValueError('Expected a (N, H, W) uint8 stack of images!')
+
+    images = list(stack)
+    if 'crop' in preprocessing_methods:
+        boxes = [profiling.call('crop', crop_box, img) for img in images]
+        images = [img[top:bottom, left:right] for img, (top, bottom, left, right) in zip(images, boxes)]
+
+    steps = []
+    if 'eq' in preprocessing_methods:
+        steps.append(('eq', _equalize_slices))
+    if 'opening' in preprocessing_methods:
+        steps.append(('opening', lambda src, dst: _opening_slices(src, dst, denoise_strength)))
+    if 'nonloc' in preprocessing_methods:
+        steps.append(('nonloc', lambda src, dst: nonloc_denoising_batch(src, denoise_strength, n_threads, out=dst)))
+    elif 'nonloc_fast' in preprocessing_methods:
+        steps.append(('nonloc_fast', lambda src, dst: nonloc_denoising_batch(src, denoise_strength, n_threads,
+                                                                             fast=True, out=dst)))
+
+    # the steps alternate between two buffers of the size of the biggest (cropped) image
+    shape = (len(images), max(img.shape[0] for img in images), max(img.shape[1] for img in images))
+    buffers = [np.zeros(shape, dtype=np.uint8) for _ in range(min(len(steps), 2))]
+    out = stack
+    for index, (name, step) in enumerate(steps):
+        out = buffers[index % 2]
+        dst = [out[i, :img.shape[0], :img.shape[1]] for i, img in enumerate(images)]
+        profiling.call(name, step, images, dst)
+        images = dst
+
+    if 'crop' in preprocessing_methods:
+        return images
+    return out
+
+
 def otsu_binarize(img, sigma=1):
-    """Return binarized image by using gaussian blurring and otsu thresholding."""
+    """Return binarized image by using gaussian blurring and otsu thresholding.
+
+    Same result as skimage.filters.gaussian (mode 'nearest', truncated at 4 sigma) followed by
+    skimage.filters.threshold_otsu, but the blur is done by OpenCV's separable filter in float32.
+    """
     if len(img.shape) == 3:
+        from skimage import color
         img = color.rgb2gray(img)
     elif len(img.shape) != 2:
         raise ValueError('Cannot handle unknown Image dimension!')
 
-    img_blur = gaussian(img, sigma=sigma)
-    otsu_thresh = threshold_otsu(img_blur)
+    if img.dtype == np.uint8:
+        img = img.astype(np.float32) * np.float32(1. / 255)
+    else:
+        img = img.astype(np.float32)
+
+    ksize = 2 * int(4 * sigma + 0.5) + 1
+    img_blur = cv.GaussianBlur(img, (ksize, ksize), sigma, borderType=cv.BORDER_REPLICATE)
+    otsu_thresh = otsu_threshold(img_blur)
     img_bin = img_blur > otsu_thresh
 
     return img_bin
 
 
+def otsu_threshold(img, nbins=256):
+    """Return the otsu threshold of the image, computed from a histogram over its value range (like skimage)."""
+    hist, bin_edges = np.histogram(img.ravel(), nbins, range=(float(img.min()), float(img.max())))
+    bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    hist = hist.astype(np.float64)
+
+    # class weights and means for every possible threshold
+    weight1 = np.cumsum(hist)
+    weight2 = np.cumsum(hist[::-1])[::-1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean1 = np.cumsum(hist * bin_centers) / weight1
+        mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+
+    # maximize the between class variance
+    variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+    return bin_centers[:-1][np.nanargmax(variance12)]
+
+
 def crop(img, border=50):
     """Return cropped image using a binarized version of that image as a mask to define the relevant region."""
+    top, bottom, left, right = crop_box(img, border)
+    return img[top:bottom, left:right]
+
+
+def crop_box(img, border=50):
+    """Return the region (top, bottom, left, right) of the image crop() cuts out."""
     # crop the white border
     border = border
     img_no_border = img[border:img.shape[0]-border, border:img.shape[1]-border]
@@ -80,18 +352,24 @@ def crop(img, border=50):
     # make a binary picture
     img_bin = otsu_binarize(img_no_border, 10)
 
-    # search the 4 outermost white pixels, crop the image there
-    white_pixels = np.where(img_bin == 1)
-    up, bottom = min(white_pixels[0]), max(white_pixels[0])
-    left, right = min(white_pixels[1]), max(white_pixels[1])
-    img_crop = img_no_border[up:bottom, left:right]
+    # search the 4 outermost white pixels (first and last row / column containing one), crop the image there
+    rows = img_bin.any(axis=1)
+    cols = img_bin.any(axis=0)
+    if not rows.any():
+        raise ValueError('Cannot crop an image without foreground!')
+    up, bottom = np.argmax(rows), len(rows) - 1 - np.argmax(rows[::-1])
+    left, right = np.argmax(cols), len(cols) - 1 - np.argmax(cols[::-1])
 
-    return img_crop
+    return border + up, border + bottom, border + left, border + right
 
 
 def hist_equalize(img):
-    """Return a histogram equalized version of the image (enhances 'contrast')."""
+    """Return a histogram equalized version of the image (enhances 'contrast').
+
+    Same result as (skimage.exposure.equalize_hist(img) * 255).astype(np.uint8), but applied as a lookup table.
+    """
     if len(img.shape) == 3:
+        from skimage import color
         img = color.rgb2gray(img) * 255
         img = img.astype(np.uint8)
 
@@ -102,10 +380,48 @@ def hist_equalize(img):
         img = img * 255
         img = img.astype(np.uint8)
 
-    eq = exposure.equalize_hist(img) * 255
-    eq = eq.astype(np.uint8)
+    return cv.LUT(img, equalize_lut(img))
 
-    return eq
+
+def equalize_lut(img):
+    """Return the lookup table of the histogram equalization of an uint8 image.
+
+    The gray levels from the minimum to the maximum of the image are mapped to their value of the
+    cumulative distribution function, scaled to 0..255 (as skimage.exposure.equalize_hist does).
+    """
+    img_min = int(img.min())
+    hist = np.bincount(img.ravel(), minlength=256)[img_min:int(img.max()) + 1]
+    cdf = hist.cumsum()
+    cdf = cdf / float(cdf[-1])
+
+    lut = np.zeros(256, dtype=np.uint8)
+    lut[img_min:img_min + len(cdf)] = (cdf * 255).astype(np.uint8)
+    return lut
+
+
+def equalize_luts(images):
+    """Return the lookup tables (N, 256) of the histogram equalization of a batch of uint8 images.
+
+    Same tables as equalize_lut() of every image, but the tables of all images are computed at once from their
+    histograms (images may be views, no copy of them is made).
+    """
+    hist = np.array([cv.calcHist([img], [0], None, [256], [0, 256]).ravel() for img in images], dtype=np.float64)
+    cdf = hist.cumsum(axis=1)
+    luts = (cdf / cdf[:, -1:] * 255).astype(np.uint8)
+
+    # only the gray levels from the minimum to the maximum of every image are mapped (see equalize_lut())
+    present = hist > 0
+    img_min = present.argmax(axis=1)
+    img_max = 255 - present[:, ::-1].argmax(axis=1)
+    levels = np.arange(256)
+    luts[(levels < img_min[:, None]) | (levels > img_max[:, None])] = 0
+    return luts
+
+
+def _equalize_slices(images, dst):
+    """Histogram equalize every image into the corresponding (preallocated) image of dst."""
+    for img, lut, out in zip(images, equalize_luts(images), dst):
+        cv.LUT(img, lut, dst=out)
 
 
 def opening_denoising(img, kernel_size=5):
@@ -117,5 +433,57 @@ def opening_denoising(img, kernel_size=5):
     return img_denoise
 
 
-def nonloc_denoising(img, denoise_strength):
-    return cv.fastNlMeansDenoising(img, h=denoise_strength)
+def _opening_slices(images, dst, kernel_size=5):
+    """Denoise every image by opening (see opening_denoising()) into the corresponding image of dst."""
+    kernel = cv.getStructuringElement(cv.MORPH_ELLIPSE, (kernel_size, kernel_size))
+    for img, out in zip(images, dst):
+        cv.morphologyEx(img, cv.MORPH_OPEN, kernel, dst=out)
+
+
+def nonloc_denoising(img, denoise_strength, template_window=NONLOC_TEMPLATE_WINDOW,
+                     search_window=NONLOC_SEARCH_WINDOW, fast=False, dst=None):
+    """Denoise image by non-local means.
+
+    :param img: uint8 gray-scale image
+    :param denoise_strength: filter strength h of the non-local means
+    :param template_window: size of the patches which are compared (odd). Larger is smoother but slower.
+    :param search_window: size of the window searched for similar patches (odd). The runtime grows with its area.
+    :param fast: denoise a half-sized version of the image and scale it back up (about 10 times faster, approximate)
+    :param dst: preallocated uint8 image of the same shape to write the result into, None to allocate it
+    :return: denoised image
+    """
+    if not fast:
+        return cv.fastNlMeansDenoising(img, dst=dst, h=denoise_strength, templateWindowSize=template_window,
+                                       searchWindowSize=search_window)
+
+    # on the half-sized image the windows are halved as well, so that they cover the same region
+    small = cv.resize(img, (max(img.shape[1] // 2, 1), max(img.shape[0] // 2, 1)), interpolation=cv.INTER_AREA)
+    small = cv.fastNlMeansDenoising(small, h=denoise_strength, templateWindowSize=max(template_window // 2 | 1, 3),
+                                    searchWindowSize=max(search_window // 2 | 1, 3))
+    return cv.resize(small, (img.shape[1], img.shape[0]), dst=dst, interpolation=cv.INTER_LINEAR)
+
+
+def nonloc_denoising_batch(images, denoise_strength, n_threads=None, template_window=NONLOC_TEMPLATE_WINDOW,
+                           search_window=NONLOC_SEARCH_WINDOW, fast=False, out=None):
+    """Denoise a batch of images by non-local means (see nonloc_denoising()) on a pool of threads.
+
+    OpenCV releases the GIL while denoising, so the images are processed concurrently.
+
+    :param images: list of uint8 gray-scale images (may be of different size, e.g. after crop())
+    :param n_threads: number of threads (default: all CPU cores)
+    :param out: list of preallocated images (of the shapes of images) to write the results into, None to allocate
+    :return: list of denoised images, in the order of images
+    """
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    if out is None:
+        out = [None] * len(images)
+
+    def denoise(img, dst):
+        return nonloc_denoising(img, denoise_strength, template_window, search_window, fast, dst)
+
+    if n_threads <= 1 or len(images) <= 1:
+        return [denoise(img, dst) for img, dst in zip(images, out)]
+
+    with ThreadPoolExecutor(max_workers=n_threads) as executor:
+        return list(executor.map(denoise, images, out))
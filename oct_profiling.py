@@ -0,0 +1,276 @@
+"""
+Profiling module for OCT image SRF detection.
+
+Per-image, per-stage instrumentation of the pipeline (load, preprocessing steps, pyramid, matching): wall time,
+shape and size of the output array and optionally the peak memory (tracemalloc) of every stage is passed to
+pluggable hooks. configure() adds a hook writing a structured log (JSONL, one record per stage and image), which
+summary() turns into a table of p50/p95/max per stage. Optionally every image is profiled with cProfile.
+
+Without hooks every instrumented call costs a single check, so the instrumentation can stay in place.
+
+Usage:
+    python oct_profiling.py profile.jsonl    # print the summary table of a structured log
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import json
+import time
+import functools
+import contextlib
+import numpy as np
+
+
+# environment variables, so that worker processes (see oct_template_matching._iter_parallel()) use the same settings
+ENV_JSONL = 'OCT_PROFILE_JSONL'
+ENV_TRACEMALLOC = 'OCT_PROFILE_TRACEMALLOC'
+ENV_CPROFILE_DIR = 'OCT_PROFILE_CPROFILE_DIR'
+
+# callables which receive every stage record (dict), profiling is disabled if there are none
+_hooks = []
+
+# image currently processed by this process and directory of the per-image cProfile output
+_current_image = None
+_cprofile_dir = None
+
+_NO_PROFILING = contextlib.nullcontext()
+
+
+class JsonlHook(object):
+    """Hook appending every record as a line of json to a file.
+
+    The file is opened for every record, so that several worker processes can append to the same file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __call__(self, record):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+
+class StageStats(object):
+    """Hook collecting the wall times of the records in memory (of this process only), see summary_table()."""
+
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record)
+
+    def summary(self):
+        return summary_table(self.records)
+
+
+def configure(jsonl_path=None, tracemalloc=False, cprofile_dir=None):
+    """Enable profiling for this process and all worker processes started afterwards.
+
+    :param jsonl_path: file the records are appended to (see JsonlHook), None for no structured log
+    :param tracemalloc: measure the peak memory allocated by every stage with tracemalloc (slows down the pipeline).
+        Requires python >= 3.9, older versions cannot reset the peak of tracemalloc (ValueError).
+    :param cprofile_dir: directory to write a cProfile file per image to (<image name>.prof), None to disable
+    """
+    if tracemalloc:
+        import tracemalloc as tm
+        if not hasattr(tm, 'reset_peak'):
+            raise ValueError('Measuring the peak memory of the stages requires python >= 3.9!')
+
+    if jsonl_path is not None:
+        os.environ[ENV_JSONL] = os.path.abspath(jsonl_path)
+    if tracemalloc:
+        os.environ[ENV_TRACEMALLOC] = '1'
+    if cprofile_dir is not None:
+        os.makedirs(cprofile_dir, exist_ok=True)
+        os.environ[ENV_CPROFILE_DIR] = os.path.abspath(cprofile_dir)
+    _configure_from_env()
+
+
+def reset():
+    """Disable profiling (remove all hooks and the configuration)."""
+    global _cprofile_dir
+    for name in [ENV_JSONL, ENV_TRACEMALLOC, ENV_CPROFILE_DIR]:
+        os.environ.pop(name, None)
+    del _hooks[:]
+    _cprofile_dir = None
+
+
+def add_hook(hook):
+    """Add a callable which receives the record (dict) of every stage, enables profiling."""
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def enabled():
+    return bool(_hooks)
+
+
+def image(image_path):
+    """Context of the processing of one image, the records of all stages inside are tagged with the image.
+
+    With a cProfile directory configured, the whole processing of the image is profiled with cProfile.
+    """
+    if not _hooks:
+        return _NO_PROFILING
+    return _image_context(image_path)
+
+
+def per_image(function):
+    """Decorator for functions processing one image (given by its path as first argument), see image()."""
+    @functools.wraps(function)
+    def wrapper(image_path, *args, **kwargs):
+        if not _hooks:
+            return function(image_path, *args, **kwargs)
+        with _image_context(image_path):
+            return function(image_path, *args, **kwargs)
+
+    return wrapper
+
+
+def call(stage, function, *args, **kwargs):
+    """Call function(*args, **kwargs) as stage of the current image and pass its record to the hooks.
+
+    :return: the return value of the function
+    """
+    if not _hooks:
+        return function(*args, **kwargs)
+
+    baseline = _tracemalloc_start()
+    start = time.perf_counter()
+    result = function(*args, **kwargs)
+    seconds = time.perf_counter() - start
+
+    record = {'image': _current_image, 'stage': stage, 'seconds': seconds, 'pid': os.getpid()}
+    if baseline is not None:
+        record['peak_bytes'] = _tracemalloc_peak() - baseline
+
+    # shape and size of the output, for functions returning a tuple of the first element (e.g. template_matching())
+    out = result[0] if isinstance(result, tuple) and result else result
+    if isinstance(out, np.ndarray):
+        record['shape'] = list(out.shape)
+        record['nbytes'] = int(out.nbytes)
+
+    _emit(record)
+    return result
+
+
+def load_records(jsonl_path):
+    """Load all records of a structured log, lines which cannot be parsed are ignored."""
+    records = []
+    with open(jsonl_path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+def summary_table(records):
+    """Return a table (string) of the calls, p50, p95 and max wall time, peak memory and output size per stage."""
+    stages = {}
+    for record in records:
+        stages.setdefault(record['stage'], []).append(record)
+
+    lines = ['{:<16}{:>7}{:>11}{:>11}{:>11}{:>14}{:>14}'.format('stage', 'calls', 'p50 ms', 'p95 ms', 'max ms',
+                                                                 'peak MiB', 'output MiB')]
+    for stage, stage_records in sorted(stages.items(), key=lambda item: -sum(r['seconds'] for r in item[1])):
+        ms = np.array([r['seconds'] for r in stage_records]) * 1000
+        peak = [r['peak_bytes'] for r in stage_records if 'peak_bytes' in r]
+        nbytes = [r['nbytes'] for r in stage_records if 'nbytes' in r]
+        lines.append('{:<16}{:>7}{:>11.2f}{:>11.2f}{:>11.2f}{:>14}{:>14}'.format(
+            stage, len(ms), np.percentile(ms, 50), np.percentile(ms, 95), ms.max(),
+            '{:.2f}'.format(max(peak) / 2 ** 20) if peak else '-',
+            '{:.2f}'.format(max(nbytes) / 2 ** 20) if nbytes else '-'))
+
+    return '\n'.join(lines)
+
+
+def summary(jsonl_path):
+    """Return the summary table (see summary_table()) of a structured log."""
+    return summary_table(load_records(jsonl_path))
+
+
+@contextlib.contextmanager
+def _image_context(image_path):
+    global _current_image
+    _current_image = str(image_path)
+    profiler = None
+    if _cprofile_dir is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - start
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(_cprofile_dir, os.path.basename(_current_image) + '.prof'))
+        _emit({'image': _current_image, 'stage': 'total', 'seconds': seconds, 'pid': os.getpid()})
+        _current_image = None
+
+
+def _emit(record):
+    for hook in _hooks:
+        hook(record)
+
+
+def _tracemalloc_start():
+    """Reset the peak of tracemalloc if it is tracing, return the memory traced before the stage (else None).
+
+    The peak of a stage is measured relative to this baseline, so that it does not include the memory of the rest
+    of the process. Python < 3.9 cannot reset the peak, no peak is recorded there.
+    """
+    import tracemalloc
+    if not tracemalloc.is_tracing() or not hasattr(tracemalloc, 'reset_peak'):
+        return None
+    tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def _tracemalloc_peak():
+    import tracemalloc
+    return tracemalloc.get_traced_memory()[1]
+
+
+def _configure_from_env():
+    """Set up the hooks of this process from the environment variables (see configure())."""
+    global _cprofile_dir
+    jsonl_path = os.environ.get(ENV_JSONL)
+    if jsonl_path and not any(isinstance(h, JsonlHook) and h.path == jsonl_path for h in _hooks):
+        add_hook(JsonlHook(jsonl_path))
+
+    if os.environ.get(ENV_TRACEMALLOC):
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    _cprofile_dir = os.environ.get(ENV_CPROFILE_DIR) or None
+    if _cprofile_dir is not None and not _hooks:
+        # cProfile output only, the records are dropped
+        add_hook(lambda record: None)
+
+
+_configure_from_env()
+
+
+if __name__ == '__main__':
+    print(summary(sys.argv[1]))
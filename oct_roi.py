@@ -0,0 +1,109 @@
+"""
+Region of interest module for OCT image SRF detection.
+
+SRF only appears in a thin band between the photoreceptor layer and the retinal pigment epithelium (RPE), see
+README.md. The RPE is localized cheaply from the per-column intensity profiles of the preprocessed image, so that the
+template matching can be restricted to a band around it instead of searching the vitreous and the choroid.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import numpy as np
+import cv2 as cv
+
+
+# pixels above and below the RPE (in the preprocessed image) which are searched for SRF
+DEFAULT_BAND = (80, 20)
+
+# width of the column chunks matched separately, so that the band can follow the curvature of the retina
+CHUNK_WIDTH = 64
+
+
+def locate_ilm(profiles):
+    """Return the row of the inner limiting membrane (top of the retina) for every column.
+
+    :param profiles: smoothed image as float np array, every column is an intensity profile
+    :return: np array of row indices, one per column
+    """
+    # the vitreous above the retina is dark, the first row brighter than half of the column maximum is the ILM
+    return np.argmax(profiles > 0.5 * profiles.max(axis=0), axis=0)
+
+
+def locate_rpe(img, max_depth=0.6, smoothing=41):
+    """Return the row of the RPE for every column of the (preprocessed) image.
+
+    The RPE is taken as the deepest bright layer of each column's intensity profile below the ILM. Bright
+    spots deep in the choroid are ignored by only searching up to max_depth of the image height below the ILM,
+    outliers of single columns are removed with a running median.
+
+    :param img: preprocessed gray-scale image (uint8)
+    :param max_depth: maximal distance from the ILM to the RPE as fraction of the image height
+    :param smoothing: width of the running median over the columns (odd)
+    :return: np array of row indices (float), one per column
+    """
+    profiles = cv.blur(img.astype(np.float32), (15, 5))
+    height = img.shape[0]
+
+    ilm = locate_ilm(profiles)
+    rows = np.arange(height)[:, None]
+    retina = np.where((rows >= ilm) & (rows < ilm + int(max_depth * height)), profiles, 0)
+
+    # deepest row which is almost as bright as the brightest row of the retina in that column
+    bright = retina >= 0.9 * retina.max(axis=0)
+    rpe = (height - 1 - np.argmax(bright[::-1], axis=0)).astype(np.float64)
+
+    return _running_median(rpe, min(smoothing, len(rpe) // 2 * 2 + 1))
+
+
+def band_regions(rpe, shape, template_shape, scale=1, band=DEFAULT_BAND, chunk_width=CHUNK_WIDTH):
+    """Return the regions of a pyramid level which are matched, i.e. the band around the RPE split in column chunks.
+
+    Every region covers all template positions whose top left corner lies in its chunk of columns and which lie
+    completely inside the band around the RPE of these columns.
+
+    :param rpe: row of the RPE for every column of the preprocessed image (see locate_rpe())
+    :param shape: shape of the pyramid level
+    :param template_shape: shape of the template
+    :param scale: scale of the pyramid level, the level is 1 / scale of the size of the preprocessed image
+    :param band: number of pixels (above, below) the RPE to search, in the preprocessed image
+    :param chunk_width: number of columns of template positions per region
+    :return: list of regions (top, bottom, left, right) in coordinates of the level
+    """
+    rows, cols = shape
+    t_rows, t_cols = template_shape
+    above, below = band[0] / scale, band[1] / scale
+
+    # RPE row of every column of the level
+    rpe = rpe[np.minimum((np.arange(cols) * scale).astype(int), len(rpe) - 1)] / scale
+
+    regions = []
+    for left in range(0, cols - t_cols + 1, chunk_width):
+        right = min(left + chunk_width + t_cols - 1, cols)
+        top = max(int(np.floor(rpe[left:right].min() - above)), 0)
+        bottom = min(int(np.ceil(rpe[left:right].max() + below)), rows)
+
+        # the band must be at least as high as the template
+        if bottom - top < t_rows:
+            bottom = min(top + t_rows, rows)
+            top = bottom - t_rows
+
+        regions.append((top, bottom, left, right))
+
+    return regions
+
+
+def _running_median(values, width):
+    """Running median of a 1D array, the borders are padded with the edge values."""
+    padded = np.pad(values, width // 2, mode='edge')
+    windows = np.lib.stride_tricks.as_strided(padded, (len(values), width), padded.strides * 2)
+    return np.median(windows, axis=1)
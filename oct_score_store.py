@@ -0,0 +1,294 @@
+"""
+Score store module for OCT image SRF detection.
+
+Columnar on-disk store of matching results, one row per image and setting: image id (content hash), image name,
+label (1 = srf, 0 = no srf, -1 = unknown), settings id (see oct_checkpoint.settings_key()) and per score column
+(matching method, or template of a bank) the best score, the location (x, y) and the scale of the best match.
+
+The store is a directory of parts, every part is a directory with one .npy file per column. Parts are written to a
+temporary directory and renamed when complete, so that several processes (e.g. the workers of the sweep) can append
+to the same store. All columns are read memory-mapped and only the rows of the requested settings are copied into
+memory, so threshold and auc studies over large datasets need neither the images nor much RAM.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import json
+import uuid
+import shutil
+import numpy as np
+import oct_cache as cache
+import oct_checkpoint as checkpoint
+import oct_template_matching as tmpmatch
+
+
+DEFAULT_STORE_DIR = 'score_store'
+
+# rows written per part while scoring, an interrupted run loses at most this many images
+CHUNK_SIZE = 256
+
+LABEL_SRF = 1
+LABEL_NO_SRF = 0
+LABEL_UNKNOWN = -1
+
+COLUMNS = ['image_id', 'image_name', 'label', 'settings_id', 'score', 'location', 'scale']
+
+
+def create(store_dir, score_columns=tmpmatch.MATCHING_METHODS):
+    """Create the store (if it does not exist yet) with the given score columns.
+
+    :param score_columns: names of the score columns, matching methods or template names
+    :return: list of the score columns of the store
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    # written to a temporary file and linked into place, so that concurrent workers never read a partial file
+    tmp_path = os.path.join(store_dir, '.columns-{}.json.tmp'.format(uuid.uuid4().hex))
+    with open(tmp_path, 'w') as f:
+        json.dump(list(score_columns), f)
+    try:
+        os.link(tmp_path, os.path.join(store_dir, 'columns.json'))
+    except FileExistsError:
+        existing = load_score_columns(store_dir)
+        if existing != list(score_columns):
+            raise ValueError('Store {} has the score columns {}, not {}!'.format(store_dir, existing,
+                                                                               list(score_columns)))
+    finally:
+        os.remove(tmp_path)
+    return list(score_columns)
+
+
+def load_score_columns(store_dir):
+    with open(os.path.join(store_dir, 'columns.json')) as f:
+        return json.load(f)
+
+
+def parts(store_dir):
+    """Return the paths of all complete parts of the store."""
+    if not os.path.isdir(store_dir):
+        return []
+    return sorted(entry.path for entry in os.scandir(store_dir) if entry.is_dir() and entry.name.startswith('part-'))
+
+
+def load_part(part_dir, columns=COLUMNS):
+    """Return dict of column name to (read-only, memory-mapped) np array of the part."""
+    return {name: np.load(os.path.join(part_dir, name + '.npy'), mmap_mode='r') for name in columns}
+
+
+def append(store_dir, image_ids, image_names, labels, settings_id, scores, locations=None, scales=None):
+    """Append rows (one per image) as a new part.
+
+    :param image_ids: content hashes of the image files (see oct_cache.file_hash())
+    :param image_names: file names of the images
+    :param labels: label of every image (LABEL_SRF, LABEL_NO_SRF or LABEL_UNKNOWN)
+    :param settings_id: settings key of the rows (see oct_checkpoint.settings_key()), or one key per row
+    :param scores: array of shape (number of images, number of score columns) of the best scores
+    :param locations: array of shape (images, score columns, 2) of the top left corners (x, y) of the best matches,
+        None if unknown (stored as -1)
+    :param scales: array of shape (images, score columns) of the scales of the best matches, None if unknown (NaN)
+    :return: path of the new part
+    """
+    scores = np.asarray(scores, dtype=np.float64).reshape(len(image_ids), -1)
+    if scores.shape[1] != len(load_score_columns(store_dir)):
+        raise ValueError('Expected {} score columns, got {}!'.format(len(load_score_columns(store_dir)),
+                                                                    scores.shape[1]))
+    if locations is None:
+        locations = np.full(scores.shape + (2,), -1)
+    if scales is None:
+        scales = np.full(scores.shape, np.nan)
+
+    columns = {
+        'image_id': np.array(image_ids, dtype='S40'),
+        'image_name': np.array([str(name) for name in image_names], dtype=np.str_),
+        'label': np.array(labels, dtype=np.int8),
+        'settings_id': np.broadcast_to(np.asarray(settings_id, dtype='S40'), (len(image_ids),)),
+        'score': scores,
+        'location': np.asarray(locations, dtype=np.int32).reshape(scores.shape + (2,)),
+        'scale': np.asarray(scales, dtype=np.float32).reshape(scores.shape),
+    }
+
+    # write to a temporary directory first, so that readers never see a partially written part
+    name = 'part-{}'.format(uuid.uuid4().hex)
+    tmp_dir = os.path.join(store_dir, '.' + name + '.tmp')
+    os.makedirs(tmp_dir)
+    for column, arr in columns.items():
+        np.save(os.path.join(tmp_dir, column + '.npy'), arr)
+    os.replace(tmp_dir, os.path.join(store_dir, name))
+    return os.path.join(store_dir, name)
+
+
+def select(store_dir, settings_id, score_column, labelled_only=True):
+    """Return the scores of one score column for all images scored with the given settings.
+
+    Only the rows of the settings are copied from the memory-mapped parts.
+
+    :param score_column: name of the score column (matching method or template name)
+    :param labelled_only: skip images with unknown label
+    :return: np array of scores, np array of the labels of the images
+    """
+    column_index = load_score_columns(store_dir).index(score_column)
+    settings_id = np.array(settings_id, dtype='S40')
+
+    scores, labels = [], []
+    for part_dir in parts(store_dir):
+        part = load_part(part_dir, ['settings_id', 'label', 'score'])
+        mask = part['settings_id'] == settings_id
+        if labelled_only:
+            mask &= part['label'] != LABEL_UNKNOWN
+        rows = np.flatnonzero(mask)
+        scores.append(part['score'][rows, column_index])
+        labels.append(part['label'][rows])
+
+    if not scores:
+        return np.zeros(0), np.zeros(0, dtype=np.int8)
+    return np.concatenate(scores), np.concatenate(labels)
+
+
+def select_images(store_dir, settings_id, image_ids):
+    """Return the scores of the given images for the settings, in the order of image_ids.
+
+    Unlike select(), the rows are chosen by image and not by their stored labels, so that the caller decides which
+    images (and which labels) are evaluated.
+
+    :param image_ids: content hashes of the images (see oct_cache.file_hash())
+    :return: np array of shape (number of images, number of score columns), NaN for images without a row
+    """
+    positions = {}
+    for position, image_id in enumerate(image_ids):
+        positions.setdefault(image_id, []).append(position)
+    wanted = np.array(list(positions), dtype='S40')
+    settings_id = np.array(settings_id, dtype='S40')
+
+    scores = np.full((len(image_ids), len(load_score_columns(store_dir))), np.nan)
+    for part_dir in parts(store_dir):
+        part = load_part(part_dir, ['image_id', 'settings_id', 'score'])
+        rows = np.flatnonzero((part['settings_id'] == settings_id) & np.isin(part['image_id'], wanted))
+        for row in rows:
+            scores[positions[part['image_id'][row].decode('ascii')]] = part['score'][row]
+    return scores
+
+
+def scored_images(store_dir, settings_id):
+    """Return the set of image ids (content hashes, str) which have a row for the given settings."""
+    settings_id = np.array(settings_id, dtype='S40')
+    image_ids = set()
+    for part_dir in parts(store_dir):
+        part = load_part(part_dir, ['image_id', 'settings_id'])
+        image_ids.update(i.decode('ascii') for i in part['image_id'][part['settings_id'] == settings_id])
+    return image_ids
+
+
+def settings_ids(store_dir):
+    """Return the number of rows per settings id of the store."""
+    counts = {}
+    for part_dir in parts(store_dir):
+        ids, n = np.unique(load_part(part_dir, ['settings_id'])['settings_id'], return_counts=True)
+        for settings_id, count in zip(ids, n):
+            counts[settings_id.decode('ascii')] = counts.get(settings_id.decode('ascii'), 0) + int(count)
+    return counts
+
+
+def compact(store_dir):
+    """Merge all parts into a single one, rows of the same image and settings are kept only once (the latest).
+
+    Must not run while other processes append to the store.
+    """
+    old_parts = parts(store_dir)
+    if len(old_parts) < 2:
+        return
+
+    # newest part first (by modification time), so that np.unique keeps the latest row of every image and settings
+    old_parts.sort(key=os.path.getmtime, reverse=True)
+    merged = {name: np.concatenate([load_part(p, [name])[name] for p in old_parts]) for name in COLUMNS}
+    keys = np.char.add(merged['image_id'], merged['settings_id'])
+    _, rows = np.unique(keys, return_index=True)
+    rows.sort()
+
+    append(store_dir, merged['image_id'][rows], merged['image_name'][rows], merged['label'][rows],
+           merged['settings_id'][rows], merged['score'][rows], merged['location'][rows], merged['scale'][rows])
+
+    for part_dir in old_parts:
+        shutil.rmtree(part_dir)
+
+
+def score_images(store_dir, image_paths, labels, template, preprocessing_methods, denoise_strength=20,
+                 n_workers=1, cache_dir=None, scales=None, backend='opencv', roi_band=None, coarse_to_fine=False,
+                 image_hashes=None):
+    """Match the images with all matching methods of the store (its score columns) and append the results.
+
+    Images which already have a row for the same settings are skipped, the rows are appended in parts of
+    CHUNK_SIZE images, so that an interrupted run resumes where it stopped.
+
+    :param store_dir: directory of the store (created with the matching methods as score columns if needed)
+    :param image_paths: list of image paths
+    :param labels: label of every image (LABEL_SRF, LABEL_NO_SRF or LABEL_UNKNOWN)
+    :param template: template as uint8 np array (see oct_template_matching.build_template())
+    :param preprocessing_methods: list of preprocessing method names (strings)
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image
+    :param coarse_to_fine: search every scale coarse to fine instead of exhaustively
+    :param image_hashes: dict of image path to content hash if already known, None to hash the images
+    :return: settings id of the rows
+    """
+    if os.path.isfile(os.path.join(store_dir, 'columns.json')):
+        matching_methods = load_score_columns(store_dir)
+    else:
+        matching_methods = create(store_dir)
+    settings_id = checkpoint.settings_key(template, preprocessing_methods, ','.join(matching_methods),
+                                          denoise_strength, scales, roi_band, coarse_to_fine)
+
+    done = scored_images(store_dir, settings_id)
+    if image_hashes is None:
+        image_hashes = {i: cache.file_hash(i) for i in image_paths}
+    todo = [(i, label) for i, label in zip(image_paths, labels) if image_hashes[i] not in done]
+    print('\n{} of {} images already in the score store, {} to go.'.format(len(image_paths) - len(todo),
+                                                                           len(image_paths), len(todo)))
+
+    kwargs = dict(template=template, preprocessing_methods=preprocessing_methods, matching_methods=matching_methods,
+                  denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales, backend=backend,
+                  roi_band=roi_band, coarse_to_fine=coarse_to_fine)
+    paths = [i for i, _ in todo]
+    if n_workers > 1:
+        results = tmpmatch._iter_parallel(paths, tmpmatch.match_image_located, n_workers, **kwargs)
+    else:
+        results = ((i, tmpmatch._run_safe(i, tmpmatch.match_image_located, **kwargs)) for i in paths)
+
+    rows = []
+    for index, ((i, (located, error)), (_, label)) in enumerate(zip(results, todo)):
+        print('\rProcessing {} ({}/{})...'.format(i, index+1, len(todo)), end='')
+        if error is not None:
+            # not stored, retried in the next run
+            print('\nWARNING: could not process {} ({})'.format(i, error))
+            continue
+        rows.append((image_hashes[i], os.path.basename(i), label, located))
+        if len(rows) == CHUNK_SIZE:
+            _append_located(store_dir, settings_id, rows)
+            rows = []
+    if rows:
+        _append_located(store_dir, settings_id, rows)
+
+    return settings_id
+
+
+def _append_located(store_dir, settings_id, rows):
+    """Append rows of (image id, image name, label, list of (score, (x, y), scale) per score column)."""
+    image_ids, names, labels, located = zip(*rows)
+    append(store_dir, image_ids, names, labels, settings_id,
+           [[score for score, _, _ in r] for r in located],
+           [[location for _, location, _ in r] for r in located],
+           [[scale for _, _, scale in r] for r in located])
+
@@ -0,0 +1,157 @@
+"""
+OCT image SRF detection service.
+
+Long-running local inference service: the calibrated model (see calibrate() in 'oct_srf_detection.py') is loaded
+once and kept warm in a pool of worker processes, so that single scans are classified without paying the start-up
+cost (imports, template building) for every request.
+
+Usage:
+    python oct_service.py [model_path] [port] [n_workers]
+
+Endpoints (on 127.0.0.1):
+    POST /score  with a json body {"paths": ["scan1.png", ...]} to classify a batch of images on the server's
+                 file system, or with the raw png bytes as body (Content-Type: image/png) to classify one scan.
+                 Returns {"results": [{"image", "score", "label", "location", "scale"}, ...]}, where location is
+                 the top left corner (x, y) of the best match in the preprocessed image.
+    GET  /health returns the settings of the loaded model.
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import json
+from concurrent.futures import ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import oct_model as model
+import oct_profiling as profiling
+import oct_preprocessing as preproc
+import oct_template_matching as tmpmatch
+
+
+DEFAULT_PORT = 8765
+
+# model of the worker process, loaded once by _init_worker()
+_model = None
+
+
+def _init_worker(model_path):
+    global _model
+    _model = model.load_model(model_path)
+
+
+def _ready():
+    """No-op task, used to start the worker processes."""
+    return os.getpid()
+
+
+def score_image(img):
+    """Preprocess, match and classify one gray-scale image with the model of the worker process.
+
+    :return: dict with the score, label, location (x, y) and scale of the best match
+    """
+    img = preproc.perform_bulk_perproc(img, _model['preproc_methods'], _model['denoise_strength'])
+    score, location, scale = tmpmatch.locate_best_match(img, _model['template'], _model['matching_method'],
+                                                        _model['scales'], roi_band=_model['roi_band'],
+                                                        coarse_to_fine=_model['coarse_to_fine'])
+    return {'score': float(score), 'label': int(model.classify(_model, [score])[0]),
+            'location': list(location), 'scale': float(scale)}
+
+
+def _score_item(item):
+    """Worker task: score an image given as ('path', image path) or ('png', encoded bytes)."""
+    kind, value = item
+    name = value if kind == 'path' else '<upload>'
+    try:
+        with profiling.image(name):
+            if kind == 'path':
+                img = profiling.call('load', preproc.load_img_as_gray, value)
+            else:
+                img = profiling.call('load', preproc.decode_img_as_gray, value)
+            result = score_image(img)
+    except Exception as e:
+        return {'image': name, 'error': '{}: {}'.format(type(e).__name__, e)}
+
+    result['image'] = name
+    return result
+
+
+class ScoreHandler(BaseHTTPRequestHandler):
+    """Request handler, the images of a request are scored in parallel on the worker pool of the server."""
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._send(404, {'error': 'unknown endpoint'})
+        settings = {key: value for key, value in self.server.model.items() if key != 'template'}
+        self._send(200, {'status': 'ok', 'model': settings})
+
+    def do_POST(self):
+        if self.path != '/score':
+            return self._send(404, {'error': 'unknown endpoint'})
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if self.headers.get('Content-Type', '').startswith('image/'):
+            items = [('png', body)]
+        else:
+            try:
+                paths = json.loads(body.decode('utf-8'))['paths']
+            except (ValueError, KeyError, TypeError):
+                paths = None
+            if not isinstance(paths, list) or not all(isinstance(path, str) for path in paths):
+                return self._send(400, {'error': 'expected png bytes or a json body {"paths": [...]}'})
+            items = [('path', path) for path in paths]
+
+        results = list(self.server.executor.map(_score_item, items))
+        self._send(200, {'results': results})
+
+    def _send(self, status, content):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def serve(model_path='srf_model.npz', port=DEFAULT_PORT, n_workers=None):
+    """Load the model and serve requests until interrupted.
+
+    :param model_path: path of the model file (see oct_model.save_model())
+    :param port: port to listen on (on 127.0.0.1 only)
+    :param n_workers: number of worker processes (default: all CPU cores)
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+
+    server = ThreadingHTTPServer(('127.0.0.1', int(port)), ScoreHandler)
+    server.model = model.load_model(model_path)
+    server.executor = ProcessPoolExecutor(max_workers=int(n_workers), initializer=_init_worker,
+                                          initargs=(model_path,))
+
+    # start the workers (imports and model loading by the initializer), so that the first request is as fast as
+    # the others
+    for future in [server.executor.submit(_ready) for _ in range(int(n_workers))]:
+        future.result()
+
+    print('Serving model {} on http://127.0.0.1:{} with {} workers...'.format(model_path, port, n_workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.executor.shutdown()
+
+
+if __name__ == '__main__':
+    serve(*sys.argv[1:])
@@ -21,10 +21,14 @@ __email__ = "dominik.meise@students.unibe.ch"
 import os
 import sys
 import glob
-import itertools
-from tqdm import tqdm
+import oct_preprocessing as preproc
 import oct_template_matching as tmpmatch
 import oct_evaluation as evaluate
+import oct_checkpoint as checkpoint
+import oct_model as model
+import oct_profiling as profiling
+import oct_sweep as sweep
+import oct_tuning as tuning
 
 
 # ======================================================================================================================
@@ -39,6 +43,13 @@ def main():
     denoise_strength = 23
     result_filename = 'project_Waelchli_Moser_Meise.csv'
     debug = False
+    n_workers = os.cpu_count()  # number of processes used for matching
+    cache_dir = '.preproc_cache'  # on-disk cache for preprocessed images, None to disable caching
+    checkpoint_path = 'checkpoint.jsonl'  # manifest of scored images to resume interrupted runs, None to disable
+    profile_path = None  # e.g. 'profile.jsonl' to log the time of every preprocessing and matching stage per image
+
+    if profile_path is not None:
+        profiling.configure(jsonl_path=profile_path)
 
     # run template matching against all input images
     print('Starting srf-detection of {} oct-images...'.format(len(image_paths)))
@@ -46,12 +57,22 @@ def main():
     print('\tPreprocessing methods: {}\n\tDenoise strength: {}\n\tMatching method: {}\n'.format(preproc_methods,
                                                                                                 denoise_strength,
                                                                                                 matching_method))
-    best_scores = tmpmatch.run_matching(image_paths, template_path, preproc_methods,
-                                        matching_method, denoise_strength, debug)
+    if checkpoint_path is None or debug:
+        best_scores = tmpmatch.run_matching(image_paths, template_path, preproc_methods,
+                                            matching_method, denoise_strength, debug, n_workers, cache_dir)
+    else:
+        # skip images already scored in a previous (interrupted) run, the scores are read from the manifest
+        template = tmpmatch.build_template(template_path, preproc_methods, denoise_strength, cache_dir)
+        best_scores = checkpoint.run_checkpointed(image_paths, template, preproc_methods, matching_method,
+                                                  denoise_strength, checkpoint_path, n_workers, cache_dir)
+
+    if profile_path is not None:
+        print('\n\nTime per stage (see {}):\n{}'.format(profile_path, profiling.summary(profile_path)))
 
     # calculate best threshold for the given method parameters
     print('\n\nCalculate best threshold based on the training data...')
-    prec, auc, thresh = evaluate.evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength)
+    prec, auc, thresh = evaluate.evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength,
+                                                     n_workers, cache_dir, checkpoint_path=checkpoint_path)
     print('\n\nBest precision: {}'.format(round(prec, 3)))
     print('at threshold: {}'.format(round(thresh, 3)))
     print('AUC: {}'.format(round(auc, 3)))
@@ -67,6 +88,61 @@ def main():
 # ======================================================================================================================
 
 
+# Calibrate the system on the training data and save it as model for 'oct_inference.py'
+def calibrate():
+    template_path = ''
+    preproc_methods = ['crop', 'eq', 'nonloc']
+    matching_method = 'cv.TM_CCOEFF_NORMED'
+    denoise_strength = 23
+    model_path = 'srf_model.npz'
+    n_workers = os.cpu_count()
+    cache_dir = '.preproc_cache'
+    roi_band = None  # e.g. oct_roi.DEFAULT_BAND to match only the band around the RPE
+    coarse_to_fine = False  # search the pyramid levels coarse to fine instead of exhaustively
+    # scores of the training images, recalibrating after adding images only matches the new ones, None to disable
+    checkpoint_path = 'checkpoint.jsonl'
+
+    print('Calculate best threshold based on the training data...')
+    prec, auc, thresh = evaluate.evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength,
+                                                     n_workers, cache_dir, roi_band, coarse_to_fine, checkpoint_path)
+    print('\n\nBest precision: {}'.format(round(prec, 3)))
+    print('at threshold: {}'.format(round(thresh, 3)))
+    print('AUC: {}'.format(round(auc, 3)))
+
+    print('Saving model in {}...'.format(model_path))
+    template = tmpmatch.build_template(template_path, preproc_methods, denoise_strength, cache_dir)
+    model.save_model(model_path, template, preproc_methods, matching_method, denoise_strength, thresh, prec, auc,
+                     roi_band=roi_band, coarse_to_fine=coarse_to_fine)
+
+
+# Streaming version of main() for large (unbounded) image directories
+def main_streaming():
+    image_dir = 'Test-Data/handout'
+    template_path = ''
+    preproc_methods = ['crop', 'eq', 'nonloc']
+    matching_method = 'cv.TM_CCOEFF_NORMED'
+    denoise_strength = 23
+    result_filename = 'project_Waelchli_Moser_Meise.csv'
+    n_workers = os.cpu_count()
+    cache_dir = '.preproc_cache'
+
+    # the threshold is needed to classify the images as they are matched, so it is calculated first
+    print('Calculate best threshold based on the training data...')
+    prec, auc, thresh = evaluate.evaluate_threshold(template_path, preproc_methods, matching_method, denoise_strength,
+                                                     n_workers, cache_dir)
+    print('\n\nBest precision: {}'.format(round(prec, 3)))
+    print('at threshold: {}'.format(round(thresh, 3)))
+
+    # load -> preprocess -> pyramid -> match -> classify, image by image, rows are written as they arrive
+    print('\nStarting streaming srf-detection of the oct-images in {}...'.format(image_dir))
+    template = tmpmatch.build_template(template_path, preproc_methods, denoise_strength, cache_dir)
+    results = tmpmatch.iter_matching(preproc.iter_image_paths(image_dir), template, preproc_methods,
+                                     matching_method, denoise_strength, n_workers, cache_dir)
+    rows = evaluate.iter_classify(results, thresh, matching_method)
+    count = evaluate.write_csv_stream(rows, result_filename)
+    print('\nSaved results of {} images in {}...'.format(count, result_filename))
+
+
 # For single run testing purposes
 def run_one_train_setting():
     images_srf = glob.glob('Train-Data/SRF/*')
@@ -89,75 +165,23 @@ def run_one_train_setting():
 
 # For batch testing and parameter optimization
 def run_all_combinations():
-    images_srf = glob.glob('Train-Data/SRF/*')
-    images_no = glob.glob('Train-Data/NoSRF/*')
-    template_path = ''
-
-    # constructing all preprocessing settings
-    all_preproc_options = ['crop', 'eq', 'opening', 'nonloc']
-    preproc_sets = []
-    for l in range(1, len(all_preproc_options)+1):
-        for subset in itertools.combinations(all_preproc_options, l):
-            if subset[0] == 'crop':  # cropping should always happen!
-                preproc_sets.append(list(subset))
-
-    # constructing all matching settings
-    all_matching_options = ['cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED', 'cv.TM_CCORR',
-                            'cv.TM_CCORR_NORMED', 'cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']
-
-    results = {}
-
-    # iterate over all preprocessing sets
-    for preproc_methods in tqdm(preproc_sets):
-        print('\nCalculating with setting: {}'.format(preproc_methods))
-
-        # ignore iterating over denoise strength if no denoising is performed in this set
-        if {'opening', 'nonloc'} & set(preproc_methods):
-            # constructing all strength settings
-            denoise_strengths = range(1, 42, 2)
-        else:
-            denoise_strengths = [0]
-
-        # iterate denoising strength
-        for denoise_strength in tqdm(denoise_strengths):
-            print('\ndenoise strength: {}'.format(denoise_strength))
-
-            # iterate over all matching methods
-            for matching_method in all_matching_options:
-                print('\nmatching method: {}'.format(matching_method))
-
-                # build label for this run
-                setting_string = '_'.join(preproc_methods) + '_' + str(denoise_strength) + \
-                                 '_' + matching_method
-
-                # run on all srf images
-                best_scores_srf = tmpmatch.run_matching(images_srf, template_path, preproc_methods,
-                                                        matching_method, denoise_strength)
-                # run on all non-srf images
-                best_scores_no = tmpmatch.run_matching(images_no, template_path, preproc_methods,
-                                                       matching_method, denoise_strength)
-
-                # testing range of thresholds
-                if 'NORMED' in matching_method:
-                    low = 0
-                    upp = 1
-                    stp = 0.0001
-                else:
-                    low = 0
-                    upp = 10000000
-                    stp = 1000
-
-                # evaluate system for this set of settings
-                prec, auc, thresh = evaluate.eval_precision(low, upp, stp, best_scores_srf, best_scores_no,
-                                                    preproc_methods, matching_method, setting_string, stdout=False)
-
-                # add current result to the results dictionnary
-                results[setting_string] = (prec, auc)
+    # the grid points are evaluated by a pool of workers from a task queue (see oct_sweep.py), an interrupted
+    # sweep resumes where it stopped and other machines can join with the same database
+    results = sweep.run_sweep(sweep.DEFAULT_DB_PATH, os.cpu_count())
 
     # save results
     evaluate.sort_result_and_save_as_txt(results)
 
 
+# Adaptive alternative to run_all_combinations(), drops losing settings early (see oct_tuning.py)
+def run_adaptive_search():
+    results, budget = tuning.successive_halving(n_workers=os.cpu_count())
+    tuning.report(results, budget)
+
+    # save results (of the settings which were evaluated on all images)
+    evaluate.sort_result_and_save_as_txt(results)
+
+
 # Quick and dirty 'stdout copy to log file' from stackoverflow:
 # https://stackoverflow.com/questions/616645/how-to-duplicate-sys-stdout-to-a-log-file
 class Logger(object):
@@ -174,4 +198,7 @@ if __name__ == '__main__':
     sys.stdout = Logger()
     # run_one_train_setting()
     # run_all_combinations()
+    # run_adaptive_search()
+    # calibrate()
+    # main_streaming()
     main()
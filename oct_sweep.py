@@ -0,0 +1,326 @@
+"""
+Hyperparameter sweep module for OCT image SRF detection.
+
+The grid of run_all_combinations() in 'oct_srf_detection.py' (preprocessing sets x denoise strengths x matching
+methods) as independent tasks in a SQLite task queue. A task is one grid point (preprocessing set, denoise
+strength), since all matching methods are evaluated on the same preprocessed images at once. Tasks are claimed by
+a pool of worker processes, the (prec, auc, thresh) of every matching method is stored as soon as the task is
+done. Reruns skip finished grid points, so an interrupted sweep loses at most the tasks which were running.
+
+Several machines can work on the same sweep by running it with the same database on a shared file system (which
+must support file locking, as required by SQLite).
+
+Usage:
+    python oct_sweep.py [db_path] [n_workers]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import os
+import sys
+import glob
+import time
+import socket
+import sqlite3
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import oct_cache as cache
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+import oct_score_store as store
+
+
+DEFAULT_DB_PATH = 'sweep.sqlite'
+
+# tasks running for longer than this (e.g. of a crashed worker or machine) are handed out again
+LEASE_SECONDS = 2 * 60 * 60
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    point TEXT PRIMARY KEY,
+    preproc_methods TEXT NOT NULL,
+    denoise_strength INTEGER NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    worker TEXT,
+    started REAL,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS results (
+    setting TEXT PRIMARY KEY,
+    point TEXT NOT NULL,
+    preproc_methods TEXT NOT NULL,
+    denoise_strength INTEGER NOT NULL,
+    matching_method TEXT NOT NULL,
+    prec REAL,
+    auc REAL,
+    thresh REAL,
+    finished REAL
+);
+'''
+
+
+def grid_points(preproc_options=('crop', 'eq', 'opening', 'nonloc'), denoise_strengths=range(1, 42, 2)):
+    """Return all grid points (preprocessing methods, denoise strength) of the sweep.
+
+    Same grid as run_all_combinations(): every subset of the preprocessing options starting with 'crop', the
+    denoise strength only varies for sets which contain a denoising method.
+    """
+    points = []
+    for l in range(1, len(preproc_options) + 1):
+        for subset in itertools.combinations(preproc_options, l):
+            if subset[0] != 'crop':  # cropping should always happen!
+                continue
+            strengths = denoise_strengths if {'opening', 'nonloc'} & set(subset) else [0]
+            points.extend((list(subset), strength) for strength in strengths)
+    return points
+
+
+def point_key(preproc_methods, denoise_strength):
+    return '{}_{}'.format('_'.join(preproc_methods), denoise_strength)
+
+
+def connect(db_path):
+    """Open the sweep database (created if it does not exist)."""
+    # autocommit mode, transactions are started explicitly where needed
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def add_tasks(conn, points):
+    """Add the grid points as pending tasks, points which are already in the queue are left as they are."""
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR IGNORE INTO tasks (point, preproc_methods, denoise_strength) VALUES (?, ?, ?)',
+                     [(point_key(p, s), ','.join(p), s) for p, s in points])
+    conn.execute('COMMIT')
+
+
+def claim_task(conn, worker):
+    """Atomically take the next pending (or abandoned) task.
+
+    :return: (point, preprocessing methods, denoise strength) or None if no task is left
+    """
+    conn.execute('BEGIN IMMEDIATE')
+    row = conn.execute("SELECT point, preproc_methods, denoise_strength FROM tasks "
+                       "WHERE status = 'pending' OR (status = 'running' AND started < ?) "
+                       "ORDER BY rowid LIMIT 1", (time.time() - LEASE_SECONDS,)).fetchone()
+    if row is not None:
+        conn.execute("UPDATE tasks SET status = 'running', worker = ?, started = ?, error = NULL WHERE point = ?",
+                     (worker, time.time(), row[0]))
+    conn.execute('COMMIT')
+
+    if row is None:
+        return None
+    return row[0], row[1].split(','), row[2]
+
+
+def requeue_abandoned(conn):
+    """Requeue the running tasks of workers of this machine which are gone (crashed or interrupted).
+
+    The tasks are handed out again without waiting for their lease to expire. Workers are identified by host name and process id. Only POSIX systems can check for a process without
+    affecting it, elsewhere abandoned tasks are handed out again once their lease expires.
+
+    :return: number of requeued tasks
+    """
+    if os.name != 'posix':
+        return 0
+
+    host = socket.gethostname()
+    abandoned = []
+    for point, worker in conn.execute("SELECT point, worker FROM tasks WHERE status = 'running'").fetchall():
+        worker_host, _, pid = (worker or '').rpartition(':')
+        if worker_host == host and pid.isdigit() and not _process_exists(int(pid)):
+            abandoned.append((point, worker))
+
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany("UPDATE tasks SET status = 'pending' WHERE point = ? AND status = 'running' AND worker = ?",
+                     abandoned)
+    conn.execute('COMMIT')
+    return len(abandoned)
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # exists, but belongs to another user
+        return True
+    return True
+
+
+def store_results(conn, point, preproc_methods, denoise_strength, results):
+    """Store the results of all matching methods of a task and mark it as done (in one transaction).
+
+    :param results: dict of matching method to (prec, auc, thresh)
+    """
+    now = time.time()
+    conn.execute('BEGIN IMMEDIATE')
+    conn.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     [(point + '_' + meth, point, ','.join(preproc_methods), denoise_strength, meth,
+                       float(prec), float(auc), float(thresh), now)
+                      for meth, (prec, auc, thresh) in results.items()])
+    conn.execute("UPDATE tasks SET status = 'done', finished = ? WHERE point = ?", (now, point))
+    conn.execute('COMMIT')
+
+
+def fail_task(conn, point, error):
+    """Mark the task as failed, failed tasks are retried by the next run of the sweep."""
+    conn.execute("UPDATE tasks SET status = 'failed', finished = ?, error = ? WHERE point = ?",
+                 (time.time(), error, point))
+
+
+def evaluate_point(images_srf, images_no, template_path, preproc_methods, denoise_strength,
+                   matching_methods=tmpmatch.MATCHING_METHODS, cache_dir=None, store_dir=None):
+    """Evaluate one grid point for all matching methods (like one step of run_all_combinations()).
+
+    :param store_dir: directory of a score store (see oct_score_store.py) to read the scores from, images which
+        are not in the store yet are matched and added to it. None to match all images without storing the scores.
+    :return: dict of matching method to (prec, auc, thresh)
+    """
+    if store_dir is None:
+        scores = tmpmatch.run_matching_all_methods(images_srf + images_no, template_path, preproc_methods,
+                                                   matching_methods, denoise_strength, 1, cache_dir)
+        method_scores = {meth: (scores[:len(images_srf), m], scores[len(images_srf):, m])
+                         for m, meth in enumerate(matching_methods)}
+    else:
+        template = tmpmatch.build_template(template_path, preproc_methods, denoise_strength, cache_dir)
+        labels = [store.LABEL_SRF] * len(images_srf) + [store.LABEL_NO_SRF] * len(images_no)
+        image_hashes = {i: cache.file_hash(i) for i in images_srf + images_no}
+        settings_id = store.score_images(store_dir, images_srf + images_no, labels, template, preproc_methods,
+                                         denoise_strength, 1, cache_dir, image_hashes=image_hashes)
+
+        # only the given images with their given labels are evaluated, whatever else the store holds for the
+        # settings (e.g. images removed from the train-data, or labelled differently when first scored)
+        scores = store.select_images(store_dir, settings_id, [image_hashes[i] for i in images_srf + images_no])
+        columns = store.load_score_columns(store_dir)
+        method_scores = {meth: (scores[:len(images_srf), columns.index(meth)],
+                                scores[len(images_srf):, columns.index(meth)]) for meth in matching_methods}
+
+    results = {}
+    for matching_method, (scores_srf, scores_no) in method_scores.items():
+        low, upp, stp = evaluate.threshold_range(matching_method)
+        setting_string = point_key(preproc_methods, denoise_strength) + '_' + matching_method
+        results[matching_method] = evaluate.eval_precision(low, upp, stp, scores_srf, scores_no, preproc_methods,
+                                                           matching_method, setting_string, stdout=False)
+    return results
+
+
+def work(db_path, template_path='', cache_dir=None, store_dir=None):
+    """Worker loop: claim and evaluate tasks until the queue is empty.
+
+    :return: number of tasks done by this worker
+    """
+    # the preprocessing methods and strength are printed by the matching functions, keep the output of workers short
+    images_srf = sorted(glob.glob('Train-Data/SRF/*'))
+    images_no = sorted(glob.glob('Train-Data/NoSRF/*'))
+    worker = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    conn = connect(db_path)
+    done = 0
+    try:
+        while True:
+            task = claim_task(conn, worker)
+            if task is None:
+                return done
+            point, preproc_methods, denoise_strength = task
+            try:
+                results = evaluate_point(images_srf, images_no, template_path, preproc_methods, denoise_strength,
+                                         cache_dir=cache_dir, store_dir=store_dir)
+            except Exception as e:
+                fail_task(conn, point, '{}: {}'.format(type(e).__name__, e))
+                continue
+            store_results(conn, point, preproc_methods, denoise_strength, results)
+            done += 1
+    finally:
+        conn.close()
+
+
+def run_sweep(db_path=DEFAULT_DB_PATH, n_workers=None, points=None, template_path='', cache_dir='.preproc_cache',
+              store_dir=store.DEFAULT_STORE_DIR):
+    """Run (or resume) the sweep on a pool of worker processes of this machine.
+
+    Other machines can join by calling run_sweep() with the same database on a shared file system.
+
+    :param db_path: path of the SQLite database holding the task queue and the results
+    :param n_workers: number of worker processes (default: all CPU cores)
+    :param points: grid points (preprocessing methods, denoise strength) to add, default: grid_points()
+    :param template_path: template to use, '' for the default template
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param store_dir: directory of the score store the scores of all images are kept in (see oct_score_store.py),
+        a rerun of a grid point (e.g. with new images) only matches the images which are not in the store yet.
+        None to keep no scores.
+    :return: dict of setting string to (prec, auc) of all finished tasks (see results()), a warning is printed if
+        tasks are not finished
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count()
+    n_workers = int(n_workers)
+
+    conn = connect(db_path)
+    # failed tasks of earlier runs are retried, as are the tasks of workers of this machine which are gone
+    conn.execute("UPDATE tasks SET status = 'pending' WHERE status = 'failed'")
+    requeued = requeue_abandoned(conn)
+    if requeued:
+        print('Requeued {} tasks of workers which are gone.'.format(requeued))
+    add_tasks(conn, grid_points() if points is None else points)
+    print('Sweep {}: {}'.format(db_path, status(conn)))
+    if store_dir is not None:
+        store.create(store_dir)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(work, db_path, template_path, cache_dir, store_dir) for _ in range(n_workers)]
+        done = sum(future.result() for future in futures)
+
+    print('\n\n{} grid points evaluated, sweep {}: {}'.format(done, db_path, status(conn)))
+    unfinished = conn.execute("SELECT COUNT(*) FROM tasks WHERE status != 'done'").fetchone()[0]
+    if unfinished:
+        # e.g. failed tasks or tasks still running on other machines, their results are missing
+        print('WARNING: {} grid points are not finished, the results are incomplete! Rerun the sweep to retry '
+              'failed tasks.'.format(unfinished))
+        for point, error in conn.execute("SELECT point, error FROM tasks WHERE status = 'failed'").fetchall():
+            print('    {}: {}'.format(point, error))
+    conn.close()
+    return results(db_path)
+
+
+def status(conn):
+    """Return the number of tasks per status as string."""
+    counts = conn.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status ORDER BY status').fetchall()
+    return ', '.join('{} {}'.format(count, status) for status, count in counts)
+
+
+def results(db_path=DEFAULT_DB_PATH, order_by='prec'):
+    """Return the results of all finished tasks as dict of setting string to (prec, auc), best first.
+
+    The setting strings are the same as those of run_all_combinations(), so the dict can be saved with
+    oct_evaluation.sort_result_and_save_as_txt().
+
+    :param order_by: 'prec' or 'auc'
+    """
+    if order_by not in ['prec', 'auc']:
+        raise ValueError('Cannot order by {}!'.format(order_by))
+
+    conn = connect(db_path)
+    rows = conn.execute('SELECT setting, prec, auc FROM results ORDER BY {} DESC'.format(order_by)).fetchall()
+    conn.close()
+    return {setting: (prec, auc) for setting, prec, auc in rows}
+
+
+if __name__ == '__main__':
+    run_sweep(*sys.argv[1:])
+    print('\nBest settings:')
+    for setting, (prec, auc) in list(results(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_DB_PATH).items())[:10]:
+        print('{}:\t({}, {})'.format(setting, round(prec, 3), round(auc, 3)))
@@ -16,74 +16,581 @@ __copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All r
 __email__ = "dominik.meise@students.unibe.ch"
 
 
+import functools
+import threading
+import collections
+from concurrent.futures import ProcessPoolExecutor
 import cv2 as cv
 import numpy as np
-from skimage import color
-from skimage.transform import pyramid_gaussian
 import oct_preprocessing as preproc
+import oct_fft_matching as fft
+import oct_roi as roi
 import oct_evaluation as evaluate
+import oct_profiling as profiling
+
+
+MATCHING_METHODS = ['cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED', 'cv.TM_CCORR',
+                    'cv.TM_CCORR_NORMED', 'cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']
 
 
 def run_matching(image_paths, template_path, preprocessing_methods, matching_method='cv.TM_SQDIFF',
-                 denoise_strength=20, debug=False):
+                 denoise_strength=20, debug=False, n_workers=1, cache_dir=None, scales=None, backend='opencv',
+                 roi_band=None, coarse_to_fine=False):
     """Run a matching task on a list of images (paths), with specified preprocessing and matching methods.
 
     :param image_paths:
     :param template_path:
     :param preprocessing_methods: list of preprocessing method names (strings). Available:
-        'crop', 'eq', 'opening', 'nonloc'
+        'crop', 'eq', 'opening', 'nonloc', 'nonloc_fast'
     :param matching_method: template matching method. Available:
         'cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED', 'cv.TM_CCORR',
         'cv.TM_CCORR_NORMED', 'cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED'
     :param denoise_strength: integer to specify how aggresively denoising should be applied.
     :param debug: boolean to enable debugging outputs (plots or print-statememts)
-    :return: list of best matching score for each image
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential).
+        Debugging plots are only available for sequential runs.
+    :param cache_dir: directory of the on-disk cache for preprocessed images (see oct_cache.py), None disables caching
+    :param scales: list of pyramid scale factors (e.g. PYRAMID_SCALES). If given, every scale is matched separately
+        (see multiscale_matching()) instead of matching against the zero-padded pyramid() mosaic.
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :param roi_band: band (above, below) around the RPE in pixels of the preprocessed image (e.g. oct_roi.DEFAULT_BAND).
+        If given, only this band is matched on every scale (see roi_matching()), None matches the whole image.
+    :param coarse_to_fine: search every scale coarse to fine (see coarse_to_fine_matching()) instead of exhaustively.
+        Much faster, but the best match is missed if it is not among the coarse candidates.
+    :return: list of best matching score for each image (in the order of image_paths). Images which could not be
+        processed get a score of NaN instead of aborting the whole batch.
     """
-    # build template
-    if template_path == '':
-        template = preproc.load_preproc_template(preprocessing_methods, denoise_strength)
-    else:
-        template = preproc.load_img_as_gray(template_path)
+    template = build_template(template_path, preprocessing_methods, denoise_strength, cache_dir)
+
+    if n_workers > 1 and not debug:
+        results = _run_parallel(image_paths, match_image, n_workers, template=template,
+                                preprocessing_methods=preprocessing_methods, matching_method=matching_method,
+                                denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales,
+                                backend=backend, roi_band=roi_band, coarse_to_fine=coarse_to_fine)
+        return [np.nan if error is not None else score for score, error in results]
 
     best_scores = []
     print('\n')
     for index, i in enumerate(image_paths):
         print('\rProcessing {} ({}/{})...'.format(i, index+1, len(image_paths)), end='')
+        score, error = _run_safe(i, match_image, template=template, preprocessing_methods=preprocessing_methods,
+                                 matching_method=matching_method, denoise_strength=denoise_strength, debug=debug,
+                                 cache_dir=cache_dir, scales=scales, backend=backend, roi_band=roi_band,
+                                 coarse_to_fine=coarse_to_fine)
+        if error is not None:
+            print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+            score = np.nan
+        best_scores.append(score)
+
+    return best_scores
 
-        img_orig = preproc.load_img_as_gray(i)
 
-        # preprocessing
-        img = preproc.perform_bulk_perproc(img_orig, preprocessing_methods, denoise_strength)
+def iter_matching(image_paths, template, preprocessing_methods, matching_method='cv.TM_SQDIFF',
+                  denoise_strength=20, n_workers=1, cache_dir=None, scales=None, backend='opencv', roi_band=None,
+                  coarse_to_fine=False, stop_at=None):
+    """Streaming version of run_matching(): yields the score of each image as soon as it is matched.
 
-        # checking perprocessing step
-        if debug:
-            evaluate.plot_original_and_processed(img_orig, img, ', '.join(preprocessing_methods))
+    The images are loaded, preprocessed, turned into a pyramid and matched one by one (or by a bounded number
+    of worker processes), so memory stays constant regardless of the number of images.
 
-        # create image pyramid
-        img_pyr = pyramid(img)
+    :param image_paths: iterable of image paths, can be a lazy generator (e.g. oct_preprocessing.iter_image_paths())
+    :param template: template as uint8 np array (see build_template())
+    :param preprocessing_methods: list of preprocessing method names (strings), see run_matching()
+    :param matching_method: template matching method, see run_matching()
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image (see run_matching())
+    :param coarse_to_fine: search every scale coarse to fine instead of exhaustively (see run_matching())
+    :param stop_at: decision threshold to stop the coarse to fine search of an image at, the scores are then only
+        good enough for the classification (see coarse_to_fine_matching())
+    :return: generator of (image path, best matching score) tuples in the order of image_paths,
+        images which could not be processed get a score of NaN
+    """
+    kwargs = dict(template=template, preprocessing_methods=preprocessing_methods, matching_method=matching_method,
+                  denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales, backend=backend,
+                  roi_band=roi_band, coarse_to_fine=coarse_to_fine, stop_at=stop_at)
 
-        # checking pyramid step
-        if debug:
-            evaluate.plot_original_and_processed(img, img_pyr)
+    if n_workers > 1:
+        results = _iter_parallel(image_paths, match_image, n_workers, **kwargs)
+    else:
+        results = ((i, _run_safe(i, match_image, **kwargs)) for i in image_paths)
+
+    for index, (i, (score, error)) in enumerate(results):
+        print('\rProcessing {} ({})...'.format(i, index+1), end='')
+        if error is not None:
+            print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+            score = np.nan
+        yield i, score
+
+
+def run_matching_all_methods(image_paths, template_path, preprocessing_methods, matching_methods=MATCHING_METHODS,
+                             denoise_strength=20, n_workers=1, cache_dir=None, scales=None, backend='opencv',
+                             batch_size=None):
+    """Run a matching task for several matching methods at once.
+
+    Every image is loaded, preprocessed and turned into a pyramid only once, all matching methods are
+    then applied to the same pyramid (the template is built once as well).
+
+    :param image_paths: list of image paths
+    :param template_path: path of the template, leave empty to use the default template (see build_template())
+    :param preprocessing_methods: list of preprocessing method names (strings), see run_matching()
+    :param matching_methods: list of template matching methods, see run_matching()
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'. The fft backend computes the correlation of
+        each pyramid only once for all methods.
+    :param batch_size: number of same-sized images (e.g. of one scanner) to load and preprocess as one stack (see
+        oct_preprocessing.perform_bulk_perproc_stack()), with scales also to turn into pyramids at once (see
+        pyramid_levels_stack()). Batches run in this process and are not cached, batches of images of different
+        sizes are matched image by image. None matches every image separately.
+    :return: np array of shape (number of images, number of matching methods) with the best matching scores.
+        Rows of images which could not be processed are NaN.
+    """
+    template = build_template(template_path, preprocessing_methods, denoise_strength, cache_dir)
+
+    if batch_size is not None:
+        if n_workers > 1:
+            raise ValueError('Batches are matched in this process, cannot combine batch_size with n_workers > 1!')
+        scores = _match_batches(image_paths, template, preprocessing_methods, matching_methods, denoise_strength,
+                                scales, backend, batch_size)
+    elif n_workers > 1:
+        results = _run_parallel(image_paths, match_image_all_methods, n_workers, template=template,
+                                preprocessing_methods=preprocessing_methods, matching_methods=matching_methods,
+                                denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales,
+                                backend=backend)
+        scores = [[np.nan] * len(matching_methods) if error is not None else row for row, error in results]
+    else:
+        scores = []
+        print('\n')
+        for index, i in enumerate(image_paths):
+            print('\rProcessing {} ({}/{})...'.format(i, index+1, len(image_paths)), end='')
+            row, error = _run_safe(i, match_image_all_methods, template=template,
+                                   preprocessing_methods=preprocessing_methods, matching_methods=matching_methods,
+                                   denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales,
+                                   backend=backend)
+            if error is not None:
+                print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+                row = [np.nan] * len(matching_methods)
+            scores.append(row)
+
+    return np.array(scores, dtype=np.float64).reshape(len(scores), len(matching_methods))
+
+
+def _match_batches(image_paths, template, preprocessing_methods, matching_methods, denoise_strength, scales, backend,
+                   batch_size):
+    """Match the images in stacks of batch_size images, see run_matching_all_methods() for the parameters.
+
+    :return: list of the best matching scores of every image (NaN for images which could not be processed)
+    """
+    scores = []
+    print('\n')
+    for start in range(0, len(image_paths), batch_size):
+        batch = image_paths[start:start + batch_size]
+        print('\rProcessing batch of {} images ({}/{})...'.format(len(batch), start + len(batch), len(image_paths)),
+              end='')
+        try:
+            stack = preproc.load_stack(batch)
+            imgs = preproc.perform_bulk_perproc_stack(stack, preprocessing_methods, denoise_strength)
+            levels = None
+            if scales is not None and isinstance(imgs, np.ndarray):
+                # the images are not cropped and still of the same size, build the pyramids of the stack at once
+                levels = profiling.call('pyramid', pyramid_levels_stack, imgs, scales)
+        except Exception:
+            # images of different sizes, or an image which cannot be loaded or preprocessed: match the images of
+            # this batch one by one, so that only the failing images get NaN scores
+            for i in batch:
+                row, error = _run_safe(i, match_image_all_methods, template=template,
+                                       preprocessing_methods=preprocessing_methods, matching_methods=matching_methods,
+                                       denoise_strength=denoise_strength, scales=scales, backend=backend)
+                if error is not None:
+                    print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+                    row = [np.nan] * len(matching_methods)
+                scores.append(row)
+            continue
 
-        # matching
-        res, img = template_matching(img_pyr, template, matching_method)
+        for index, (i, img) in enumerate(zip(batch, imgs)):
+            img_levels = None if levels is None else [(scale, level[index]) for scale, level in levels]
+            try:
+                row = _match_all_methods(img, template, matching_methods, scales, backend, levels=img_levels)
+            except Exception as e:
+                print('\nWARNING: could not process {} ({}: {}), score set to NaN'.format(i, type(e).__name__, e))
+                row = [np.nan] * len(matching_methods)
+            scores.append(row)
+
+    return scores
+
+
+def run_matching_bank(image_paths, templates, preprocessing_methods, matching_method='cv.TM_SQDIFF',
+                      denoise_strength=20, n_workers=1, cache_dir=None, scales=None, backend='opencv'):
+    """Run a matching task of a whole bank of templates against a list of images.
+
+    Every image is loaded, preprocessed and turned into a pyramid only once, all templates are then matched
+    against the same pyramid. With the fft backend the FFT of the pyramid is shared by all templates as well.
+
+    :param image_paths: list of image paths
+    :param templates: list of templates as uint8 np arrays (see oct_preprocessing.load_template_bank())
+    :param preprocessing_methods: list of preprocessing method names (strings), see run_matching()
+    :param matching_method: template matching method, see run_matching()
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param n_workers: number of worker processes used to match the images in parallel (1 = sequential)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'
+    :return: np array of shape (number of images, number of templates) with the best matching scores.
+        Rows of images which could not be processed are NaN.
+    """
+    if n_workers > 1:
+        results = _run_parallel(image_paths, match_image_bank, n_workers, templates=templates,
+                                preprocessing_methods=preprocessing_methods, matching_method=matching_method,
+                                denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales,
+                                backend=backend)
+        scores = [[np.nan] * len(templates) if error is not None else row for row, error in results]
+    else:
+        scores = []
+        print('\n')
+        for index, i in enumerate(image_paths):
+            print('\rProcessing {} ({}/{})...'.format(i, index+1, len(image_paths)), end='')
+            row, error = _run_safe(i, match_image_bank, templates=templates,
+                                   preprocessing_methods=preprocessing_methods, matching_method=matching_method,
+                                   denoise_strength=denoise_strength, cache_dir=cache_dir, scales=scales,
+                                   backend=backend)
+            if error is not None:
+                print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+                row = [np.nan] * len(templates)
+            scores.append(row)
+
+    return np.array(scores, dtype=np.float64).reshape(len(scores), len(templates))
+
+
+def build_template(template_path, preprocessing_methods, denoise_strength, cache_dir=None):
+    """Return the template as uint8 np array.
+
+    :param template_path: path of the template image, leave empty to cut the template from the first train-data
+        srf image with the given preprocessing applied (see oct_preprocessing.load_preproc_template())
+    :param preprocessing_methods: list of preprocessing method names (strings)
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    """
+    if template_path == '':
+        return preproc.load_preproc_template(preprocessing_methods, denoise_strength, cache_dir)
+    else:
+        return preproc.load_img_as_gray(template_path)
+
+
+@profiling.per_image
+def match_image(image_path, template, preprocessing_methods, matching_method='cv.TM_SQDIFF',
+                denoise_strength=20, debug=False, cache_dir=None, scales=None, backend='opencv', roi_band=None,
+                coarse_to_fine=False, stop_at=None, workspace=None):
+    """Load, preprocess and match a single image against the (already preprocessed) template.
+
+    :param image_path: path of the image to match
+    :param template: template as uint8 np array
+    :param preprocessing_methods: list of preprocessing method names (strings), see run_matching()
+    :param matching_method: template matching method, see run_matching()
+    :param denoise_strength: integer to specify how aggresively denoising should be applied.
+    :param debug: boolean to enable debugging outputs (plots or print-statememts)
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image (see run_matching())
+    :param coarse_to_fine: search every pyramid level coarse to fine instead of exhaustively (see run_matching())
+    :param stop_at: decision threshold to stop the coarse to fine search at (see coarse_to_fine_matching())
+    :param workspace: buffers reused across images (see MatchWorkspace), None for the workspace of this thread
+    :return: best matching score of the image
+    """
+    # loading and preprocessing
+    img = preproc.load_and_preproc(image_path, preprocessing_methods, denoise_strength, cache_dir)
+
+    # checking perprocessing step
+    if debug:
+        evaluate.plot_original_and_processed(preproc.load_img_as_gray(image_path), img,
+                                             ', '.join(preprocessing_methods))
+
+    if scales is not None or roi_band is not None or coarse_to_fine:
+        # match every pyramid level separately
+        levels, rpe = _prepare_levels(img, scales, roi_band, coarse_to_fine)
+        score, top_left, scale = _search_levels(levels, rpe, template, matching_method, backend, roi_band,
+                                                coarse_to_fine, stop_at)
 
         # checking matching step
         if debug:
-            evaluate.plot_original_and_processed(res, img)
+            print('\nbest match at {} on scale {}'.format(top_left, round(scale, 2)))
 
-        # store minimum value found (best match)
-        # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
-        if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
-            best_scores.append(np.amin(res))
-        else:
-            best_scores.append(np.amax(res))
+        return score
+
+    if workspace is None:
+        workspace = thread_workspace()
+
+    # create image pyramid
+    img_pyr = profiling.call('pyramid', pyramid, img, workspace.get('pyramid', pyramid_shape(img.shape)))
+
+    # checking pyramid step
+    if debug:
+        evaluate.plot_original_and_processed(img, img_pyr)
+
+    # matching, the best match is only drawn for debugging
+    res, img = profiling.call('match', template_matching, img_pyr, template, matching_method, backend, debug,
+                              workspace.get('result', result_shape(img_pyr.shape, template.shape), np.float32))
+
+    # checking matching step
+    if debug:
+        evaluate.plot_original_and_processed(res, img)
+
+    return best_score(res, matching_method)
+
+
+@profiling.per_image
+def match_image_all_methods(image_path, template, preprocessing_methods, matching_methods=MATCHING_METHODS,
+                            denoise_strength=20, cache_dir=None, scales=None, backend='opencv', workspace=None):
+    """Like match_image(), but returns the best matching score for each of the given matching methods."""
+    img = preproc.load_and_preproc(image_path, preprocessing_methods, denoise_strength, cache_dir)
+    return _match_all_methods(img, template, matching_methods, scales, backend, workspace)
+
+
+def _match_all_methods(img, template, matching_methods, scales, backend, workspace=None, levels=None):
+    """Return the best matching score of a preprocessed image for each of the matching methods.
+
+    :param levels: pyramid levels of the image if already built (e.g. by pyramid_levels_stack()), only with scales
+    """
+    if workspace is None:
+        workspace = thread_workspace()
+
+    if scales is not None:
+        if levels is None:
+            levels = profiling.call('pyramid', pyramid_levels, img, scales)
+        if backend != 'fft':
+            return [multiscale_matching(levels, template, meth, backend)[0] for meth in matching_methods]
+        images = [level for _, level in levels
+                  if level.shape[0] >= template.shape[0] and level.shape[1] >= template.shape[1]]
+    else:
+        img_pyr = profiling.call('pyramid', pyramid, img, workspace.get('pyramid', pyramid_shape(img.shape)))
+        if backend != 'fft':
+            result = workspace.get('result', result_shape(img_pyr.shape, template.shape), np.float32)
+            return [best_score(template_matching(img_pyr, template, meth, backend, result=result)[0], meth)
+                    for meth in matching_methods]
+        images = [img_pyr]
+
+    # fft backend: a single correlation per image for all the methods
+    level_scores = [[best_score(res, meth) for res, meth in zip(fft.match_methods(i, template, matching_methods),
+                                                                 matching_methods)]
+                    for i in images]
+    return [best_score(np.array(scores), meth) for scores, meth in zip(zip(*level_scores), matching_methods)]
+
+
+@profiling.per_image
+def match_image_bank(image_path, templates, preprocessing_methods, matching_method='cv.TM_SQDIFF',
+                     denoise_strength=20, cache_dir=None, scales=None, backend='opencv'):
+    """Like match_image(), but returns the best matching score for each template of the bank."""
+    img = preproc.load_and_preproc(image_path, preprocessing_methods, denoise_strength, cache_dir)
+
+    if scales is not None:
+        images = [level for _, level in profiling.call('pyramid', pyramid_levels, img, scales)]
+    else:
+        images = [profiling.call('pyramid', pyramid, img)]
+
+    if backend == 'fft':
+        # transform every image only once for all templates
+        images = [fft.SpectralImage(i) for i in images]
+
+    scores = []
+    for template in templates:
+        level_scores = [best_score(match_template(i, template, matching_method, backend), matching_method)
+                        for i in images if _fits(template, i)]
+        scores.append(best_score(np.array(level_scores), matching_method))
+
+    return scores
+
+
+@profiling.per_image
+def match_image_located(image_path, template, preprocessing_methods, matching_methods=MATCHING_METHODS,
+                        denoise_strength=20, cache_dir=None, scales=None, backend='opencv', roi_band=None,
+                        coarse_to_fine=False):
+    """Like match_image_all_methods(), but also locates the best match of every method (see locate_best_match()).
+
+    :return: list of (best score, top left corner (x, y), scale) tuples, one per matching method
+    """
+    img = preproc.load_and_preproc(image_path, preprocessing_methods, denoise_strength, cache_dir)
+    return locate_best_matches(img, template, matching_methods, scales, backend, roi_band, coarse_to_fine)
+
+
+def locate_best_match(img, template, matching_method='cv.TM_SQDIFF', scales=None, backend='opencv', roi_band=None,
+                      coarse_to_fine=False, stop_at=None):
+    """Match the template against the pyramid of an (already preprocessed) image and locate the best match.
+
+    :param img: preprocessed image as uint8 np array
+    :param template: template as uint8 np array
+    :param matching_method: template matching method, see run_matching()
+    :param scales: list of pyramid scale factors to match separately, None to match the pyramid() mosaic
+    :param backend: template matching backend, 'opencv' or 'fft'
+    :param roi_band: band (above, below) around the RPE to match, None to match the whole image (see run_matching())
+    :param coarse_to_fine: search every pyramid level coarse to fine instead of exhaustively (see run_matching())
+    :param stop_at: decision threshold to stop the coarse to fine search at (see coarse_to_fine_matching())
+    :return: best score, top left corner (x, y) of the best match in coordinates of the preprocessed image
+        and scale of the pyramid level of the best match
+    """
+    return locate_best_matches(img, template, [matching_method], scales, backend, roi_band, coarse_to_fine,
+                               stop_at)[0]
+
+
+def locate_best_matches(img, template, matching_methods=MATCHING_METHODS, scales=None, backend='opencv',
+                        roi_band=None, coarse_to_fine=False, stop_at=None):
+    """Like locate_best_match(), but for several matching methods on the same pyramid (and RPE) of the image.
+
+    :return: list of (best score, top left corner (x, y), scale) tuples, one per matching method
+    """
+    if scales is not None or roi_band is not None or coarse_to_fine:
+        levels, rpe = _prepare_levels(img, scales, roi_band, coarse_to_fine)
+        located = []
+        for meth in matching_methods:
+            score, (x, y), scale = _search_levels(levels, rpe, template, meth, backend, roi_band, coarse_to_fine,
+                                                  stop_at)
+            located.append((score, (int(x * scale), int(y * scale)), scale))
+        return located
+
+    workspace = thread_workspace()
+    img_pyr = profiling.call('pyramid', pyramid, img, workspace.get('pyramid', pyramid_shape(img.shape)))
+    result = workspace.get('result', result_shape(img_pyr.shape, template.shape), np.float32)
+    located = []
+    for meth in matching_methods:
+        res = profiling.call('match', match_template, img_pyr, template, meth, backend, result)
+        score, (x, y) = best_location(res, meth)
+
+        # find the level of the mosaic the match lies in (levels are stacked vertically, see pyramid())
+        row = 0
+        for scale in PYRAMID_SCALES:
+            height = int(img.shape[0] / scale)
+            if y < row + height:
+                break
+            row += height
+        located.append((score, (int(x * scale), int((y - row) * scale)), scale))
+
+    return located
+
+
+def _prepare_levels(img, scales, roi_band, coarse_to_fine):
+    """Return the pyramid levels of the image and, if a roi band is searched, its RPE (else None)."""
+    if roi_band is not None and coarse_to_fine:
+        raise ValueError('The coarse to fine search cannot be combined with a roi band!')
+
+    levels = profiling.call('pyramid', pyramid_levels, img, scales)
+    rpe = profiling.call('roi', roi.locate_rpe, img) if roi_band is not None else None
+    return levels, rpe
+
+
+def _search_levels(levels, rpe, template, matching_method, backend, roi_band, coarse_to_fine, stop_at):
+    """Match every pyramid level separately (see _prepare_levels()), see match_image() for the parameters.
+
+    :return: best score, top left corner (x, y) of the best match in the image of its level and scale of that level
+    """
+    if roi_band is not None:
+        # match only the band around the RPE of every pyramid level
+        return profiling.call('match', roi_matching, levels, template, matching_method, rpe, roi_band, backend)
+
+    if coarse_to_fine:
+        return profiling.call('match', coarse_to_fine_matching, levels, template, matching_method, stop_at=stop_at,
+                              backend=backend)
+
+    return profiling.call('match', multiscale_matching, levels, template, matching_method, backend)
+
+
+def best_score(res, matching_method):
+    """Return the best score of a template matching result map."""
+    # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
+    if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+        return np.amin(res)
+    else:
+        return np.amax(res)
+
+
+def best_location(res, matching_method):
+    """Return the best score of a template matching result map and its location (x, y)."""
+    min_val, max_val, min_loc, max_loc = cv.minMaxLoc(res)
+
+    # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
+    if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+        return min_val, min_loc
+    else:
+        return max_val, max_loc
+
+
+def _better_match(best, res, matching_method, scale, left=0, top=0):
+    """Return the better of best and the best match of the result map res of a level (region).
+
+    :param best: best (score, (x, y), scale) so far, None if there is none yet
+    :param left, top: offset of the matched region in the image of its level
+    :return: best (score, (x, y), scale)
+    """
+    score, (x, y) = best_location(res, matching_method)
+    if best is None:
+        return score, (left + x, top + y), scale
+    if matching_method in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']:
+        return (score, (left + x, top + y), scale) if score < best[0] else best
+    return (score, (left + x, top + y), scale) if score > best[0] else best
+
+
+def _fits(template, image):
+    """Check if the template is not bigger than the image (np array or fft.SpectralImage)."""
+    shape = image.image.shape if isinstance(image, fft.SpectralImage) else image.shape
+    return shape[0] >= template.shape[0] and shape[1] >= template.shape[1]
+
+
+def _run_safe(image_path, task, **kwargs):
+    """Worker task of the process pool: runs task(image_path, **kwargs), returns (result, error message)."""
+    try:
+        return task(image_path, **kwargs), None
+    except Exception as e:
+        return None, '{}: {}'.format(type(e).__name__, e)
 
-    return best_scores
 
+def _run_parallel(image_paths, task, n_workers, **kwargs):
+    """Run task(image_path, **kwargs) for all images on a pool of n_workers processes.
 
-def template_matching(image, template, meth='cv.TM_SQDIFF'):
+    :return: list of (result, error message) tuples in the order of image_paths, the error message is None
+        for successful tasks, the result is None for failed tasks.
+    """
+    results = []
+    print('\n')
+    for index, (i, result) in enumerate(_iter_parallel(image_paths, task, n_workers, **kwargs)):
+        print('\rProcessing {} ({}/{})...'.format(i, index+1, len(image_paths)), end='')
+        results.append(result)
+
+    for i, (_, error) in zip(image_paths, results):
+        if error is not None:
+            print('\nWARNING: could not process {} ({}), score set to NaN'.format(i, error))
+
+    return results
+
+
+def _iter_parallel(image_paths, task, n_workers, **kwargs):
+    """Lazily run task(image_path, **kwargs) on a pool of n_workers processes.
+
+    Only a bounded number of images is submitted ahead of the consumer, so that an arbitrarily long (lazy)
+    iterable of image paths can be processed with constant memory.
+
+    :return: generator of (image_path, (result, error message)) tuples in the order of image_paths
+    """
+    job = functools.partial(_run_safe, task=task, **kwargs)
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        pending = collections.deque()
+        for i in image_paths:
+            pending.append((i, executor.submit(job, i)))
+            # keep every worker busy, with one task queued per worker
+            if len(pending) >= 2 * n_workers:
+                i, future = pending.popleft()
+                yield i, future.result()
+
+        while pending:
+            i, future = pending.popleft()
+            yield i, future.result()
+
+
+def template_matching(image, template, meth='cv.TM_SQDIFF', backend='opencv', draw=False, result=None):
     """Match the template against the image, return resolution and location map.
 
     :param image: input image in which to search for the template matching (either rgb or grayscale)
@@ -91,16 +598,21 @@ def template_matching(image, template, meth='cv.TM_SQDIFF'):
     :param meth: template matching method. Available:
         'cv.TM_CCOEFF', 'cv.TM_CCOEFF_NORMED', 'cv.TM_CCORR',
         'cv.TM_CCORR_NORMED', 'cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED'
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :param draw: draw a square at the location of the best match into a copy of the image (for debugging)
+    :param result: preallocated float32 array to write the distance map into (see match_template())
     :return: res: the distance map of the template matching the input image
                   (depending on the method either higher or lower is better)
-             img: image with a square at the location of the best match
+             img: copy of the image with a square at the location of the best match if draw, else the image
     """
+    # Apply template Matching
+    res = match_template(image, template, meth, backend, result)
+    if not draw:
+        return res, image
+
     img = image.copy()
     w, h = template.shape[::-1]
     method = eval(meth)
-
-    # Apply template Matching
-    res = cv.matchTemplate(img, template, method)
     min_val, max_val, min_loc, max_loc = cv.minMaxLoc(res)
 
     # If the method is TM_SQDIFF or TM_SQDIFF_NORMED, take minimum
@@ -115,37 +627,283 @@ def template_matching(image, template, meth='cv.TM_SQDIFF'):
     return res, img
 
 
-def pyramid(img):
-    """Returns downscaled and smoothed image (with scikit-image)
+def match_template(image, template, meth='cv.TM_SQDIFF', backend='opencv', result=None):
+    """Return the distance map of the template matching the image, computed with the given backend.
 
-    :param img: image as uint8, grayscaled
+    :param image: gray-scale image
+    :param template: kernel/template which to match against the input image
+    :param meth: template matching method, see template_matching()
+    :param backend: 'opencv' for cv.matchTemplate or 'fft' for the frequency domain matching of oct_fft_matching.py,
+        which gives the same scores within floating point tolerance
+    :param result: preallocated float32 array of the shape of the distance map (see result_shape()) to write it
+        into, None to allocate it. Only used by the opencv backend.
     """
+    if backend == 'opencv':
+        return cv.matchTemplate(image, template, eval(meth), result)
+    elif backend == 'fft':
+        return fft.match_template(image, template, meth)
+    else:
+        raise ValueError('Unknown matching backend {}!'.format(backend))
 
-    # dimension of new image as tuple
-    scale_min = 0.5  # meaning biggest image 1 / 0.5 = 2
-    scale_max = 2    # meaning smallest image 1 / 2 = 0.5
 
-    # create first image with lowest scale --> biggest picture comes first
-    dim = (int(img.shape[1] / scale_min), int(img.shape[0] / scale_min))
-    first = cv.resize(img, dim, interpolation=cv.INTER_AREA)
+# scale factors of the image pyramid, the image is resized to 1 / scale of its size
+# (first/biggest image at scale 0.5, i.e. twice the size, then from 0.51 to 1.91 in steps of 0.1)
+PYRAMID_SCALES = [0.5] + list(np.arange(0.5 + 0.01, 2, 0.1))
 
-    img_pyr = first.copy()
+# coarse to fine search (see coarse_to_fine_matching()): downscaling factor, number of refined candidates per level
+# and minimal template size of the coarse search
+COARSE_FACTOR = 2
+COARSE_TOP_K = 5
+COARSE_MIN_SIZE = 8
 
-    for scale in np.arange(scale_min+0.01, scale_max, 0.1):
-        dim = (int(img.shape[1] / scale), int(img.shape[0] / scale))
-        img_d = cv.resize(img, dim, interpolation=cv.INTER_AREA)
 
-        img_d_1 = np.pad(img_d, ((0, 0), (0, first.shape[1] - img_d.shape[1])), mode='constant', constant_values=(0))
+def pyramid(img, out=None):
+    """Returns downscaled and smoothed image (with scikit-image)
 
-        img_pyr = np.concatenate((img_pyr, img_d_1))
+    :param img: image as uint8, grayscaled
+    :param out: preallocated array of pyramid_shape(img.shape) to build the mosaic in (e.g. of a MatchWorkspace),
+        None to allocate it
+    """
+    # all levels are stacked vertically, left aligned and zero-padded to the width of the first/biggest image.
+    # Every level is resized directly into its place in the mosaic.
+    if out is None:
+        img_pyr = np.zeros(pyramid_shape(img.shape), dtype=img.dtype)
+    else:
+        img_pyr = out
+    row = 0
+    for scale in PYRAMID_SCALES:
+        dim = (int(img.shape[1] / scale), int(img.shape[0] / scale))
+        cv.resize(img, dim, dst=img_pyr[row:row + dim[1], :dim[0]], interpolation=cv.INTER_AREA)
+        if out is not None:
+            # the padding of a reused buffer is not zero
+            img_pyr[row:row + dim[1], dim[0]:] = 0
+        row += dim[1]
 
     # cv.imshow("", img_pyr)
     # cv.waitKey(0)
     return img_pyr
 
 
+def pyramid_shape(img_shape):
+    """Return the shape of the pyramid() mosaic of an image of the given shape."""
+    return (sum(int(img_shape[0] / scale) for scale in PYRAMID_SCALES), int(img_shape[1] / PYRAMID_SCALES[0]))
+
+
+def result_shape(img_shape, template_shape):
+    """Return the shape of the distance map of matching a template against an image (see match_template())."""
+    return img_shape[0] - template_shape[0] + 1, img_shape[1] - template_shape[1] + 1
+
+
+class MatchWorkspace(object):
+    """Buffers which are reused for matching one image after another (pyramid mosaic, distance maps).
+
+    Every buffer is allocated on the first request and only reallocated for a bigger one, so matching a long batch
+    of images allocates (almost) nothing per image. Arrays built in a workspace are views of its buffers and only
+    valid until the next image is matched with the same workspace.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def get(self, name, shape, dtype=np.uint8):
+        """Return the (uninitialized) buffer of the given name as array of the given shape and dtype."""
+        size = int(np.prod(shape))
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.dtype != dtype or buffer.size < size:
+            buffer = np.empty(size, dtype=dtype)
+            self._buffers[name] = buffer
+            self.allocations += 1
+        return buffer[:size].reshape(shape)
+
+    def nbytes(self):
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+
+_local = threading.local()
+
+
+def thread_workspace():
+    """Return the MatchWorkspace of the current thread (of the current worker process)."""
+    if not hasattr(_local, 'workspace'):
+        _local.workspace = MatchWorkspace()
+    return _local.workspace
+
+
+def pyramid_levels(img, scales=None):
+    """Return the levels of the image pyramid as separate images.
+
+    :param img: image as uint8, grayscaled
+    :param scales: list of scale factors, the image is resized to 1 / scale of its size (default: PYRAMID_SCALES)
+    :return: list of (scale, resized image) tuples
+    """
+    if scales is None:
+        scales = PYRAMID_SCALES
+
+    levels = []
+    for scale in scales:
+        dim = (int(img.shape[1] / scale), int(img.shape[0] / scale))
+        levels.append((scale, cv.resize(img, dim, interpolation=cv.INTER_AREA)))
+
+    return levels
+
+
+def pyramid_levels_stack(stack, scales=None, out=None):
+    """Like pyramid_levels(), but for a (N, H, W) stack of same-sized images (see oct_preprocessing.load_stack()).
+
+    Every image is resized into its slice of one (N, h, w) buffer per scale.
+
+    :param stack: (N, H, W) uint8 array of images
+    :param scales: list of scale factors (default: PYRAMID_SCALES)
+    :param out: buffers of a previous call (same stack shape and scales) to resize into, None to allocate them
+    :return: list of (scale, (N, h, w) uint8 array) tuples
+    """
+    if scales is None:
+        scales = PYRAMID_SCALES
+
+    levels = []
+    for index, scale in enumerate(scales):
+        dim = (int(stack.shape[2] / scale), int(stack.shape[1] / scale))
+        level = np.empty((len(stack), dim[1], dim[0]), dtype=stack.dtype) if out is None else out[index][1]
+        for img, dst in zip(stack, level):
+            cv.resize(img, dim, dst=dst, interpolation=cv.INTER_AREA)
+        levels.append((scale, level))
+
+    return levels
+
+
+def multiscale_matching(levels, template, meth='cv.TM_SQDIFF', backend='opencv'):
+    """Match the template against every pyramid level separately and return the overall best match.
+
+    In contrast to matching against the pyramid() mosaic, no padding is searched and no match can span
+    two levels.
+
+    :param levels: list of (scale, image) tuples (see pyramid_levels())
+    :param template: kernel/template which to match against the images
+    :param meth: template matching method, see template_matching()
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :return: best score, top left corner (x, y) of the best match in the image of its level and scale of that level
+    """
+    best = None
+    for scale, level in levels:
+        # skip levels which are smaller than the template
+        if level.shape[0] < template.shape[0] or level.shape[1] < template.shape[1]:
+            continue
+
+        best = _better_match(best, match_template(level, template, meth, backend), meth, scale)
+
+    if best is None:
+        raise ValueError('Template is bigger than all pyramid levels!')
+
+    return best
+
+
+def roi_matching(levels, template, meth='cv.TM_SQDIFF', rpe=None, band=roi.DEFAULT_BAND, backend='opencv'):
+    """Like multiscale_matching(), but only the band around the RPE of every pyramid level is matched.
+
+    The band is matched in chunks of columns (see oct_roi.band_regions()), so that it follows the curvature of
+    the retina.
+
+    :param levels: list of (scale, image) tuples (see pyramid_levels())
+    :param template: kernel/template which to match against the images
+    :param meth: template matching method, see template_matching()
+    :param rpe: row of the RPE for every column of the preprocessed image (see oct_roi.locate_rpe())
+    :param band: number of pixels (above, below) the RPE to search, in the preprocessed image
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :return: best score, top left corner (x, y) of the best match in the image of its level and scale of that level
+    """
+    best = None
+    for scale, level in levels:
+        # skip levels which are smaller than the template
+        if not _fits(template, level):
+            continue
+
+        for top, bottom, left, right in roi.band_regions(rpe, level.shape, template.shape, scale, band):
+            res = match_template(level[top:bottom, left:right], template, meth, backend)
+            best = _better_match(best, res, meth, scale, left, top)
+
+    if best is None:
+        raise ValueError('Template is bigger than all pyramid levels!')
+
+    return best
+
+
+def coarse_to_fine_matching(levels, template, meth='cv.TM_SQDIFF', factor=COARSE_FACTOR, top_k=COARSE_TOP_K,
+                            stop_at=None, backend='opencv'):
+    """Like multiscale_matching(), but every level is searched coarse to fine instead of exhaustively.
+
+    The template is matched on a downscaled version of the level first, only the neighborhoods of the top_k
+    best (locally optimal) coarse matches are matched again at full resolution. The returned score is an exact
+    full resolution score, but the best match can be missed if it is not among the coarse candidates
+    (see 'benchmarks/bench_coarse_to_fine.py' for the deviation from the exhaustive search).
+
+    :param levels: list of (scale, image) tuples (see pyramid_levels())
+    :param template: kernel/template which to match against the images
+    :param meth: template matching method, see template_matching()
+    :param factor: downscaling factor of the coarse search
+    :param top_k: number of coarse candidates per level which are refined at full resolution
+    :param stop_at: decision threshold, the search stops as soon as a match reaches it (the classification
+        cannot change anymore, but the score is not necessarily the best one). None searches all levels.
+    :param backend: template matching backend, 'opencv' (cv.matchTemplate) or 'fft' (see oct_fft_matching.py)
+    :return: best score, top left corner (x, y) of the best match in the image of its level and scale of that level
+    """
+    lower_is_better = meth in ['cv.TM_SQDIFF', 'cv.TM_SQDIFF_NORMED']
+    t_rows, t_cols = template.shape
+    coarse_template = cv.resize(template, (t_cols // factor, t_rows // factor), interpolation=cv.INTER_AREA)
+
+    best = None
+    for scale, level in levels:
+        # skip levels which are smaller than the template
+        if not _fits(template, level):
+            continue
+
+        coarse = cv.resize(level, (level.shape[1] // factor, level.shape[0] // factor), interpolation=cv.INTER_AREA)
+        if min(coarse_template.shape) < COARSE_MIN_SIZE or not _fits(coarse_template, coarse):
+            # too small to be searched coarsely, search this level exhaustively
+            candidates = [(0, 0, level.shape[1] - t_cols, level.shape[0] - t_rows)]
+        else:
+            res = match_template(coarse, coarse_template, meth, backend)
+            candidates = []
+            for x, y in _top_candidates(res, top_k, lower_is_better, max(coarse_template.shape) // 2):
+                # neighborhood (left, top, right, bottom) of top left corners around the candidate
+                candidates.append((max(x * factor - factor, 0), max(y * factor - factor, 0),
+                                   min(x * factor + 2 * factor, level.shape[1] - t_cols),
+                                   min(y * factor + 2 * factor, level.shape[0] - t_rows)))
+
+        for left, top, right, bottom in candidates:
+            res = match_template(level[top:bottom + t_rows, left:right + t_cols], template, meth, backend)
+            best = _better_match(best, res, meth, scale, left, top)
+
+        # early exit once the decision threshold is crossed
+        if stop_at is not None and (best[0] <= stop_at if lower_is_better else best[0] >= stop_at):
+            break
+
+    if best is None:
+        raise ValueError('Template is bigger than all pyramid levels!')
+
+    return best
+
+
+def _top_candidates(res, top_k, lower_is_better, radius):
+    """Return the locations (x, y) of the top_k best scores of res which are at least radius apart."""
+    res = -res if lower_is_better else res.copy()
+    candidates = []
+    for _ in range(top_k):
+        _, max_val, _, (x, y) = cv.minMaxLoc(res)
+        if max_val == -np.inf:
+            break
+        candidates.append((x, y))
+        # suppress the neighborhood of the candidate
+        res[max(y - radius, 0):y + radius + 1, max(x - radius, 0):x + radius + 1] = -np.inf
+
+    return candidates
+
+
 def fast_pyramid(img):
     """Faster pyramid function, but limited by high scale factors, results in WORSE template matching."""
+    from skimage import color
+    from skimage.transform import pyramid_gaussian
+
     rows, cols = img.shape
     pyrmd = tuple(pyramid_gaussian(img, downscale=2, multichannel=False))
 
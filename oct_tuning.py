@@ -0,0 +1,261 @@
+"""
+Adaptive hyperparameter search module for OCT image SRF detection.
+
+Alternatives to the exhaustive grid of run_all_combinations() (see 'oct_sweep.py') which find the best setting
+with a fraction of the image passes (loading, preprocessing and matching of one image for one grid point):
+
+- successive halving: all settings are evaluated on a small, balanced subset of the train-data, only the best
+  1/eta of them (and of the grid points) on a subset eta times larger, and so on until the survivors are evaluated
+  on all images. Scores of images already matched for a grid point are reused in the next round.
+- bayesian: grid points are evaluated on all images one after another, the next one is the unevaluated grid point
+  with the highest expected improvement under a gaussian process fitted to the precisions so far.
+
+The objective is the precision (ties broken by the auc) as computed by oct_evaluation.eval_precision(). Both
+searches report the image passes spent compared to the full grid.
+
+Usage:
+    python oct_tuning.py [halving|bayesian] [n_workers]
+
+final exercise from the lecture:
+Introduction to Signal and Image Processing FS19
+by:
+Prof. Raphael Sznitman
+
+See README.md for the full exercise description.
+"""
+
+__author__ = "Jan Wälchli, Mario Moser, Dominik Meise"
+__copyright__ = "Copyright 2019; Jan Wälchli, Mario Moser, Dominik Meise; All rigths reserved."
+__email__ = "dominik.meise@students.unibe.ch"
+
+
+import sys
+import glob
+import math
+import numpy as np
+import oct_template_matching as tmpmatch
+import oct_evaluation as evaluate
+import oct_sweep as sweep
+
+
+PREPROC_OPTIONS = ['crop', 'eq', 'opening', 'nonloc']
+
+
+class ScoreTable(object):
+    """Best matching scores of the images per grid point, every image is matched only once per grid point.
+
+    Also counts the image passes (one image matched for one grid point, for all requested matching methods).
+    """
+
+    def __init__(self, image_paths, template_path='', n_workers=1, cache_dir=None):
+        self.image_paths = image_paths
+        self.template_path = template_path
+        self.n_workers = n_workers
+        self.cache_dir = cache_dir
+        self.scores = {}
+        self.passes = 0
+
+    def get(self, point, matching_methods, n_images):
+        """Return the scores of the first n_images images for the grid point, matching only the missing ones.
+
+        :return: dict of matching method to np array of n_images scores
+        """
+        preproc_methods, denoise_strength = point
+        key = sweep.point_key(preproc_methods, denoise_strength)
+        point_scores = self.scores.setdefault(key, {})
+
+        missing = [m for m in matching_methods if len(point_scores.get(m, [])) < n_images]
+        if missing:
+            # methods still needed at this point are matched on all images they lack (at most n_images)
+            done = min(len(point_scores.get(m, [])) for m in missing)
+            new_scores = tmpmatch.run_matching_all_methods(self.image_paths[done:n_images], self.template_path,
+                                                           preproc_methods, missing, denoise_strength,
+                                                           self.n_workers, self.cache_dir)
+            self.passes += n_images - done
+            for method_index, matching_method in enumerate(missing):
+                old = point_scores.get(matching_method, np.zeros(0))[:done]
+                point_scores[matching_method] = np.concatenate([old, new_scores[:, method_index]])
+
+        return {m: point_scores[m][:n_images] for m in matching_methods}
+
+
+def balanced_order(images_srf, images_no, seed=0):
+    """Shuffle both classes and interleave them, so that every prefix of the list is (close to) balanced.
+
+    :return: list of image paths, np array of labels (1 = srf)
+    """
+    rng = np.random.RandomState(seed)
+    images_srf = list(rng.permutation(images_srf))
+    images_no = list(rng.permutation(images_no))
+
+    paths, labels = [], []
+    for i in range(max(len(images_srf), len(images_no))):
+        for images, label in [(images_srf, 1), (images_no, 0)]:
+            if i < len(images):
+                paths.append(images[i])
+                labels.append(label)
+    return paths, np.array(labels)
+
+
+def evaluate_config(scores, labels, matching_method):
+    """Return (prec, auc) of a matching method given the scores of the images and their labels."""
+    prec, auc, _ = evaluate.score_precision(scores[labels == 1], scores[labels == 0], matching_method)
+    return prec, auc
+
+
+def setting_string(point, matching_method):
+    return sweep.point_key(*point) + '_' + matching_method
+
+
+def successive_halving(points=None, matching_methods=tmpmatch.MATCHING_METHODS, min_images=6, eta=2, seed=0,
+                       template_path='', n_workers=1, cache_dir='.preproc_cache'):
+    """Successive halving over all settings (grid point and matching method) on growing subsets of the train-data.
+
+    :param points: grid points (preprocessing methods, denoise strength), default: oct_sweep.grid_points()
+    :param matching_methods: matching methods to combine with every grid point
+    :param min_images: number of images of the first round
+    :param eta: only the best 1/eta of the settings survive a round, the next round uses eta times more images
+    :param seed: seed of the image order
+    :param template_path: template to use, '' for the default template
+    :param n_workers: number of worker processes used for matching
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :return: dict of setting string to (prec, auc) of the settings evaluated on all images (best first)
+             and dict of the budget spent (see _budget())
+    """
+    points = sweep.grid_points(PREPROC_OPTIONS) if points is None else points
+    image_paths, labels = balanced_order(glob.glob('Train-Data/SRF/*'), glob.glob('Train-Data/NoSRF/*'), seed)
+    table = ScoreTable(image_paths, template_path, n_workers, cache_dir)
+
+    configs = [(point, meth) for point in points for meth in matching_methods]
+    n_images = min(min_images, len(image_paths))
+    while True:
+        print('\n{} settings on {} images...'.format(len(configs), n_images))
+        ranking = []
+        for point in _unique_points(configs):
+            methods = [meth for p, meth in configs if p == point]
+            scores = table.get(point, methods, n_images)
+            for meth in methods:
+                ranking.append(((point, meth), evaluate_config(scores[meth], labels[:n_images], meth)))
+        ranking.sort(key=lambda item: item[1], reverse=True)
+
+        if n_images == len(image_paths) or len(configs) == 1:
+            break
+        configs = _survivors([config for config, _ in ranking], eta)
+        n_images = min(n_images * eta, len(image_paths))
+
+    if n_images < len(image_paths):
+        # a single survivor before all images were used, evaluate it on all of them as well
+        (point, meth), _ = ranking[0]
+        scores = table.get(point, [meth], len(image_paths))
+        ranking = [((point, meth), evaluate_config(scores[meth], labels, meth))]
+
+    results = {setting_string(point, meth): result for (point, meth), result in ranking}
+    return results, _budget(table, points, image_paths)
+
+
+def bayesian_search(points=None, matching_methods=tmpmatch.MATCHING_METHODS, n_iter=20, n_initial=5, seed=0,
+                    template_path='', n_workers=1, cache_dir='.preproc_cache'):
+    """Bayesian optimization over the grid points, every evaluated grid point is matched on all images.
+
+    All matching methods are evaluated on the same pass, the objective of a grid point is the best precision of
+    its matching methods. After n_initial random grid points, the point with the highest expected improvement
+    under a gaussian process (features: preprocessing methods one-hot, scaled denoise strength) is evaluated next.
+
+    :param points: grid points (preprocessing methods, denoise strength), default: oct_sweep.grid_points()
+    :param matching_methods: matching methods to evaluate at every grid point
+    :param n_iter: number of grid points to evaluate
+    :param n_initial: number of randomly chosen grid points to start with
+    :param seed: seed of the random choices
+    :param template_path: template to use, '' for the default template
+    :param n_workers: number of worker processes used for matching
+    :param cache_dir: directory of the on-disk cache for preprocessed images, None disables caching
+    :return: dict of setting string to (prec, auc) of the evaluated settings (best first)
+             and dict of the budget spent (see _budget())
+    """
+    from sklearn.gaussian_process import GaussianProcessRegressor
+    from sklearn.gaussian_process.kernels import Matern, WhiteKernel
+    from scipy.stats import norm
+
+    points = sweep.grid_points(PREPROC_OPTIONS) if points is None else points
+    image_paths, labels = balanced_order(glob.glob('Train-Data/SRF/*'), glob.glob('Train-Data/NoSRF/*'), seed)
+    table = ScoreTable(image_paths, template_path, n_workers, cache_dir)
+    rng = np.random.RandomState(seed)
+
+    features = np.array([[option in preproc for option in PREPROC_OPTIONS] + [strength / 41]
+                         for preproc, strength in points], dtype=np.float64)
+    evaluated, objective, ranking = [], [], []
+    for i in range(min(n_iter, len(points))):
+        candidates = [j for j in range(len(points)) if j not in evaluated]
+        if i < n_initial:
+            j = candidates[rng.randint(len(candidates))]
+        else:
+            gp = GaussianProcessRegressor(Matern(nu=2.5) + WhiteKernel(1e-3), normalize_y=True, random_state=seed)
+            gp.fit(features[evaluated], objective)
+            mean, std = gp.predict(features[candidates], return_std=True)
+            std = np.maximum(std, 1e-9)
+            z = (mean - max(objective)) / std
+            j = candidates[int(np.argmax((mean - max(objective)) * norm.cdf(z) + std * norm.pdf(z)))]
+
+        print('\nEvaluating grid point {} ({}/{})...'.format(sweep.point_key(*points[j]), i + 1, n_iter))
+        scores = table.get(points[j], matching_methods, len(image_paths))
+        results = [((points[j], meth), evaluate_config(scores[meth], labels, meth)) for meth in matching_methods]
+        ranking.extend(results)
+        evaluated.append(j)
+        objective.append(max(prec for _, (prec, _) in results))
+
+    ranking.sort(key=lambda item: item[1], reverse=True)
+    results = {setting_string(point, meth): result for (point, meth), result in ranking}
+    return results, _budget(table, points, image_paths)
+
+
+def report(results, budget):
+    """Print the best settings found and the budget spent compared to the full grid."""
+    print('\nBest settings:')
+    for setting, (prec, auc) in list(results.items())[:5]:
+        print('{}:\t({}, {})'.format(setting, round(prec, 3), round(auc, 3)))
+    print('\nImage passes: {} of {} for the full grid ({}%)'.format(budget['passes'], budget['grid_passes'],
+                                                                   round(100 * budget['fraction'], 1)))
+
+
+def _budget(table, points, image_paths):
+    """Return the image passes spent and those of the full grid (every grid point on every image)."""
+    grid_passes = len(points) * len(image_paths)
+    return {'passes': table.passes, 'grid_passes': grid_passes, 'fraction': table.passes / grid_passes}
+
+
+def _survivors(ranked_configs, eta):
+    """Return the settings surviving a round of successive halving.
+
+    An image pass of a grid point matches all its matching methods at once, so the best 1/eta of the grid points
+    (ranked by their best setting) survive, each with those of its settings which are among the best 1/eta of all
+    settings (at least its best one).
+    """
+    n_points = int(math.ceil(len(_unique_points(ranked_configs)) / eta))
+    n_configs = int(math.ceil(len(ranked_configs) / eta))
+    points = _unique_points(ranked_configs)[:n_points]
+
+    survivors, seen = [], []
+    for rank, (point, meth) in enumerate(ranked_configs):
+        if point in points and (rank < n_configs or point not in seen):
+            survivors.append((point, meth))
+        seen.append(point)
+    return survivors
+
+
+def _unique_points(configs):
+    points = []
+    for point, _ in configs:
+        if point not in points:
+            points.append(point)
+    return points
+
+
+if __name__ == '__main__':
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'halving'
+    n_workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    if mode == 'halving':
+        report(*successive_halving(n_workers=n_workers))
+    elif mode == 'bayesian':
+        report(*bayesian_search(n_workers=n_workers))
+    else:
+        raise ValueError('Unknown search: {}'.format(mode))